@@ -1,275 +1,57 @@
 #!/usr/bin/env python3
 
-import hashlib
-import argparse
 import os
-import shutil
-import sys
-import re
-import exif
 import time
-import math
+import threading
 import wx
+from multiprocessing import freeze_support
 from pprint import pformat
+import camera_mover
+from camera_mover.exif_data import get_full_class_name
 
-version = '1.0.3'
-global dry_run
+version = '1.1.0'
 
 exceptions = {}
+exception_samples = 20
 
 
-strftime = time.strftime
-gmtime = time.gmtime
+class ProgressPoster:
+    # hands status text from the worker thread to a label on the ui thread,
+    # at most once every interval seconds so the ui isn't flooded with
+    # updates on big jobs
+    def __init__(self, label, interval=0.1):
+        self.label = label
+        self.interval = interval
+        self.posted = 0
 
-
-class HiddenPrints:
-    def __enter__(self):
-        self._original_stderr = sys.stderr
-        sys.stderr = open(os.devnull, 'w')
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stderr.close()
-        sys.stderr = self._original_stderr
-
-
-def process_args():
-    description = ("A tool to find all jpg images in a directory and copy them"
-                   " to the destination directory with names based on exif "
-                   "data.\n\nIt is recommended to run this against directories"
-                   " where all images are from the same source.")
-    parser = argparse.ArgumentParser(description=description)
-    parser.add_argument("source",
-                        help="directory to search for jpg images")
-    parser.add_argument("destination",
-                        help="directory for sorted jpg images")
-    parser.add_argument("--skip-dups", action="store_true",
-                        help="check for and skip duplicate images")
-    parser.add_argument("--dry-run", action="store_true",
-                        help="provide an action list instead of copying files")
-    parser.add_argument("--destructive", action="store_true",
-                        help=("move jpg images instead of copying them\nthis "
-                              "option will also delete duplicates when paired "
-                              "with --skip-dups\nThis has no impact if "
-                              "--dry-run has been set"))
-    parser.add_argument("--error-name",
-                        help=("provide a name to prepend to files when exif "
-                              "data cannot be found"))
-    return (parser.parse_args())
-
-
-def char_squash(s, ch):
-    # this was taken from stackoverflow and I don't fully understand it yet.
-    new_str = []
-    l = len(s)
-    for i in range(len(s)):
-        if (s[i] == ch and i != (l-1) and
-           i != 0 and s[i + 1] != ch and s[i-1] != ch):
-            new_str.append(s[i])
-        elif s[i] == ch:
-            if ((i != (l-1) and s[i + 1] == ch) and
-               (i != 0 and s[i-1] != ch)):
-                new_str.append(s[i])
-        else:
-            new_str.append(s[i])
-    return ("".join(i for i in new_str))
-
-
-def path_cleaner(in_str):
-    invalid_chars = ("/", "<", ">", ":", '"', "\\", "|", "?", "*", ",", ".",
-                     " ", "&", "%")
-    for char in invalid_chars:
-        in_str = char_squash(in_str.replace(char, "-"), "-")
-    return (in_str)
-
-
-def image_listing2(directory, frame):
-    listing = []
-    for p, d, f in os.walk(directory):
-        for file in f:
-            wx.Yield()
-            if re.match(".*(JP|jp)((eg|EG)|G|g)$", file):
-                full_path = os.path.join(p, file)
-                listing.append(full_path)
-                process_out = (f"Enumerating: {len(listing)}")
-                frame.sts_details.SetLabel(process_out)
-    return (listing)
-
-
-def get_full_class_name(obj):
-    # source: https://stackoverflow.com/a/58045927/3957324
-    module = obj.__class__.__module__
-    if module is None or module == str.__class__.__module__:
-        return obj.__class__.__name__
-    return module + '.' + obj.__class__.__name__
+    def __call__(self, text, force=False):
+        now = time.monotonic()
+        if force or now - self.posted >= self.interval:
+            self.posted = now
+            wx.CallAfter(self.label.SetLabel, text)
 
 
 def add_image_exception(image, exception):
+    # every exception is counted but only the first few files are kept as
+    # examples, a big card full of bad exif would otherwise hold every path
     try:
         exceptions[exception]['count'] += 1
-        exceptions[exception]['files'].append(image)
     except KeyError:
         exceptions[exception] = {}
         exceptions[exception]['count'] = 1
         exceptions[exception]['files'] = []
+    if len(exceptions[exception]['files']) < exception_samples:
         exceptions[exception]['files'].append(image)
 
 
-def exif_parse2(file_content, image):
-    try:
-        exif_object = exif.Image(file_content)
-    except Exception as e:
-        add_image_exception(image, get_full_class_name(e))
-        return (1)
-    if exif_object.has_exif:
-        with HiddenPrints():
-            exif_dict = exif_object.get_all()
-        return (exif_dict)
-    else:
-        return (1)
-
-
-def name_gen2(image, exif_dict):
-    try:
-        make = exif_dict['make']
-    except Exception as e:
-        add_image_exception(image, get_full_class_name(e))
-        make = "brand"
-    try:
-        model = exif_dict['model']
-    except Exception as e:
-        add_image_exception(image, get_full_class_name(e))
-        model = "camera"
-    try:
-        date = exif_dict['datetime'].replace(":", "-").replace(" ", "T")
-    except Exception as e:
-        add_image_exception(image, get_full_class_name(e))
-        date = strftime("%Y-%m-%dT%H-%M-%S", gmtime(os.path.getmtime(image)))
-    name = path_cleaner("_".join((make, model, date)))
-    return (name)
-
-
-def dup_check(name, md5_hashes):
-    with open(name, 'rb') as image:
-        content = image.read()
-        content_hash = hashlib.md5(content).hexdigest()
-    try:
-        if md5_hashes[content_hash]:
-            return_code = content_hash
-    except KeyError:
-        return_code = 0
-        md5_hashes[content_hash] = name
-    return (return_code)
-
-
-def dup_check2(name, content, md5_hashes):
-    content_hash = hashlib.md5(content).hexdigest()
-    try:
-        if md5_hashes[content_hash]:
-            return_code = content_hash
-    except KeyError:
-        return_code = 0
-        md5_hashes[content_hash] = name
-    return (return_code)
-
-
-def name_check(name, name_bases):
-    try:
-        name_bases[name] += 1
-    except KeyError:
-        name_bases[name] = 1
-    count = name_bases[name]
-    name = "_".join((name, str(count).rjust(3, "0")))
-    name = name + ".jpg"
-    return (name)
-
-
-def action_parser(image, out_name, destination, destructive, dry_run):
-    src_action = "copy"
-    dup_action = "ignore"
-    if destructive:
-        src_action = "move"
-        dup_action = "delete"
-    dry_name = os.path.join(destination, "camera_copy.csv")
-    full_name = os.path.join(destination, out_name)
-    if dry_run:
-        with open(dry_name, "+a", encoding="utf-8") as out_file:
-            if "DUP of" in out_name:
-                out_file.write(f'"{dup_action}","{image}","{out_name}"\n')
-            else:
-                out_file.write(f'"{src_action}","{image}","{full_name}"\n')
-    else:
-        if "DUP of" in out_name:
-            if dup_action == "delete":
-                os.remove(image)
-        else:
-            if src_action == "move":
-                shutil.move(image, full_name)
-            else:
-                shutil.copy(image, full_name)
-
-
-def list_review(image_list, check_dup, destination, destructive, dry, frame):
-    name_bases = {}
-    dup_list = {}
-    conv_list = {}
-    item_count = 0
-    dup_count = 0
-    time_run = math.floor(time.time())
-    time_cnt = 0
-    item_total = len(image_list)
-    for image in image_list:
-        # print(image)
-        item_count += 1
-        percent = math.floor((item_count / item_total) * 100)
-        time_now = math.floor(time.time())
-        time_cnt += 1
-        process_out = (f"Files Processed: {item_count} of "
-                       f"{item_total} ({percent}%)\r")
-        frame.sts_details.SetLabel(process_out)
-        wx.Yield()
-        with open(image, "rb") as image_handle:
-            image_content = image_handle.read()
-        if check_dup:
-            dup_val = dup_check2(image, image_content, dup_list)
-            if dup_val == 0:
-                # this chunk seems ripe for functionalizing
-                exif_data = exif_parse2(image_content, image)
-                if exif_data != 1:
-                    base_name = name_gen2(image, exif_data)
-                    out_name = name_check(base_name, name_bases)
-                else:
-                    mod_time = strftime("%Y-%m-%dT%H-%M-%S",
-                                        gmtime(os.path.getmtime(image)))
-                    base_name = "bad_exif_" + mod_time
-                    out_name = name_check(base_name, name_bases)
-            else:
-                dup_count += 1
-                out_name = f"DUP of {dup_list[dup_val]}"
-        else:
-            # this chunk is a copy of the last chunk
-            exif_data = exif_parse2(image_content, image)
-            if exif_data != 1:
-                base_name = name_gen2(image, exif_data)
-                out_name = name_check(base_name, name_bases)
-            else:
-                mod_time = strftime("%Y-%m-%dT%H-%M-%S",
-                                    gmtime(os.path.getmtime(image)))
-                base_name = "bad_exif_" + mod_time
-                out_name = name_check(base_name, name_bases)
-        conv_list[image] = out_name
-        action_parser(image, out_name, destination, destructive, dry)
-    return (item_count, dup_count, len(conv_list))
-
-
-def camera_copy(src, dst, frame, dup=False, destructive=False, dry_run=True):
-    exceptions = {}
-    images = image_listing2(src, frame)
-    if dry_run:
-        dry_name = os.path.join(dst, "camera_copy.csv")
-        with open(dry_name, "w", encoding="utf-8") as out_file:
-            out_file.write(f'"action","source","destination"\n')
-    list_counts = list_review(images, dup, dst, destructive, dry_run, frame)
-    return (list_counts)
+def camera_copy(src, dst, progress, cancel, dup=False, destructive=False,
+                dry_run=True, jobs=1):
+    # runs on a worker thread, progress and cancel are how it talks to the
+    # window
+    exceptions.clear()
+    return (camera_mover.camera_copy(src, dst, dup, destructive, dry_run,
+                                     jobs, progress=progress, cancel=cancel,
+                                     on_error=add_image_exception))
 
 
 class ErrorFrame(wx.Frame):
@@ -324,6 +106,9 @@ class MainFrame(wx.Frame):
         self.chk_dups = wx.CheckBox(panel, -1, label="Skip Duplicates")
         self.chk_dest = wx.CheckBox(panel, -1, label="Delete Sources")
         self.chk_dryr = wx.CheckBox(panel, -1, label="Dry Run")
+        label_jobs = wx.StaticText(panel, -1, label="Jobs")
+        self.spn_jobs = wx.SpinCtrl(panel, -1, size=(50, -1), min=1,
+                                    max=(os.cpu_count() or 1), initial=1)
         # status interface
         # self.sts_box = wx.StaticBox(panel, -1, "Status", size=(380, 100))
         self.sts_details = wx.StaticText(panel, -1, "Ready", size=(380, 60))
@@ -331,8 +116,17 @@ class MainFrame(wx.Frame):
         self.btn_okay = wx.Button(panel, -1, "Copy")
         self.btn_okay.Bind(wx.EVT_BUTTON, self.on_okay)
         self.btn_okay.Disable()
+        self.btn_stop = wx.Button(panel, -1, "Cancel")
+        self.btn_stop.Bind(wx.EVT_BUTTON, self.on_stop)
+        self.btn_stop.Disable()
         self.btn_cncl = wx.Button(panel, -1, "Exit")
         self.btn_cncl.Bind(wx.EVT_BUTTON, self.on_cncl)
+        self.cancel = threading.Event()
+        # the close box works while a job runs too, on_close stops the job
+        # first and on_done closes the window once it has
+        self.running = False
+        self.closing = False
+        self.Bind(wx.EVT_CLOSE, self.on_close)
         # source sizer
         src_sizer = wx.BoxSizer(wx.HORIZONTAL)
         src_sizer.Add(label_src, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
@@ -348,6 +142,8 @@ class MainFrame(wx.Frame):
         opt_sizer.Add(self.chk_dups, 0, 0, 0)
         opt_sizer.Add(self.chk_dest, 0, 0, 0)
         opt_sizer.Add(self.chk_dryr, 0, 0, 0)
+        opt_sizer.Add(label_jobs, 0, wx.ALIGN_CENTER_VERTICAL | wx.LEFT, 5)
+        opt_sizer.Add(self.spn_jobs, 0, wx.LEFT, 5)
         # status_sizer
         sts_sizer = wx.BoxSizer(wx.HORIZONTAL)
         sts_sizer = wx.StaticBoxSizer(wx.HORIZONTAL, panel, "Status")
@@ -355,6 +151,7 @@ class MainFrame(wx.Frame):
         # confirmation sizer
         btn_sizer = wx.BoxSizer(wx.HORIZONTAL)
         btn_sizer.Add(self.btn_okay, 0, 0, 0)
+        btn_sizer.Add(self.btn_stop, 0, 0, 0)
         btn_sizer.Add(self.btn_cncl, 0, 0, 0)
         # top level sizer
         org_sizer = wx.BoxSizer(wx.VERTICAL)
@@ -367,6 +164,7 @@ class MainFrame(wx.Frame):
 
     def toggleUI(self, status=False):
         if status:
+            self.btn_stop.Enable()
             self.btn_okay.Disable()
             self.btn_cncl.Disable()
             self.btn_src.Disable()
@@ -374,7 +172,9 @@ class MainFrame(wx.Frame):
             self.chk_dest.Disable()
             self.chk_dups.Disable()
             self.chk_dryr.Disable()
+            self.spn_jobs.Disable()
         else:
+            self.btn_stop.Disable()
             self.btn_okay.Enable()
             self.btn_cncl.Enable()
             self.btn_src.Enable()
@@ -382,6 +182,7 @@ class MainFrame(wx.Frame):
             self.chk_dest.Enable()
             self.chk_dups.Enable()
             self.chk_dryr.Enable()
+            self.spn_jobs.Enable()
 
     def on_src(self, e):
         self.edit_src.SetValue(wx.DirSelector("Choose a source directory"))
@@ -404,18 +205,40 @@ class MainFrame(wx.Frame):
         skip_dups = self.chk_dups.GetValue()
         destructive = self.chk_dest.GetValue()
         dry_run = self.chk_dryr.GetValue()
+        jobs = self.spn_jobs.GetValue()
         out_string = (f"Source: {cam_source}\n"
                       f"Target: {cam_target}\n"
                       f"skip_dups={skip_dups}\n"
                       f"destructive={destructive}\n"
                       f"dry-run={dry_run}")
-        camera_results = camera_copy(cam_source, cam_target, self, skip_dups,
-                                     destructive, dry_run)
+        self.cancel.clear()
+        self.running = True
+        progress = ProgressPoster(self.sts_details)
+        job = threading.Thread(target=self.run_job, daemon=True,
+                               args=(cam_source, cam_target, progress,
+                                     skip_dups, destructive, dry_run, jobs))
+        job.start()
+
+    def run_job(self, cam_source, cam_target, progress, *options):
+        # the copy runs here, off the ui thread
+        try:
+            camera_results = camera_copy(cam_source, cam_target, progress,
+                                         self.cancel, *options)
+        except Exception as e:
+            add_image_exception(cam_source, get_full_class_name(e))
+            camera_results = (0, 0, 0)
+        wx.CallAfter(self.on_done, camera_results)
+
+    def on_done(self, camera_results):
+        self.running = False
+        if self.closing:
+            self.Close()
+            return
         output = (f'Files Processed: {camera_results[0]}\n'
                   f'Duplicates Skipped: {camera_results[1]}\n'
                   f'Files to Move: {camera_results[2]}\n')
-        process_out = (f"Files Processed: {camera_results[0]} of "
-                       f"{camera_results[0]} (100%)\r")
+        if self.cancel.is_set():
+            output = "Cancelled\n" + output
         self.sts_details.SetLabel(output)
         if len(exceptions) > 0:
             for key in exceptions:
@@ -429,9 +252,26 @@ class MainFrame(wx.Frame):
             #               wx.OK | wx.ICON_INFORMATION)
         self.toggleUI()
 
+    def on_stop(self, e):
+        # the job stops between files, on_done tidies up once it has
+        self.btn_stop.Disable()
+        self.cancel.set()
+
     def on_cncl(self, e):
         self.Close()
 
+    def on_close(self, e):
+        # closing mid job would kill the worker thread half way through a
+        # transfer, so the job is cancelled and on_done closes the window
+        if self.running and e.CanVeto():
+            self.closing = True
+            self.btn_stop.Disable()
+            self.cancel.set()
+            self.sts_details.SetLabel("Stopping...")
+            e.Veto()
+            return
+        e.Skip()
+
 
 def main():
     win_title = "Camera Copy GUI"
@@ -450,4 +290,8 @@ def main():
     app.MainLoop()
 
 
-main()
+if __name__ == "__main__":
+    # worker processes re-import this file on Windows, so the window must
+    # only be opened by the parent process
+    freeze_support()
+    main()
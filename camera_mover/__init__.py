@@ -0,0 +1,27 @@
+# the engine behind camera_copy.py and camera_copy_GUI.py. importing this
+# doesn't pull in exif, xxhash or wx, they are only loaded once something
+# needs them.
+import importlib
+
+from .actions import Journal, PlanWriter, action_parser, plan_apply
+from .engine import (ImageScan, camera_copy, image_listing2, image_review,
+                     image_reviews, list_review)
+from .exif_data import exif_header, exif_parse2
+from .hashing import DupIndex, dup_check, dup_check2
+from .index import ArchiveIndex, MetaCache
+from .naming import name_check, name_gen2, path_cleaner
+from .shards import shard_review, shards_merge
+from .transfer import transfer_file
+
+version = '0.5.0'
+
+# only imported once asked for, like engine does for --watch and several
+# sources
+lazy_names = {"DirWatcher": ".watch", "DeviceScan": ".sources"}
+
+
+def __getattr__(name):
+    if name in lazy_names:
+        return (getattr(importlib.import_module(lazy_names[name], __name__),
+                        name))
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,9 @@
+from .cli import main
+
+if __name__ == "__main__":
+    # the guard keeps worker processes from re-running main() on platforms
+    # that spawn instead of fork
+    try:
+        main()
+    except (BrokenPipeError, KeyboardInterrupt):
+        blob = True
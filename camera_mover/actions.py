@@ -0,0 +1,314 @@
+import csv
+import json
+import os
+import time
+from functools import partial
+
+from .transfer import action_run, dir_ensure, transfer_job, transfer_stage
+
+
+plan_fields = ("action", "source", "destination", "size", "mtime_ns",
+               "destination_dir")
+plan_actions = ("copy", "move", "ignore", "delete")
+
+
+class Journal:
+    # append-only record of the actions taken on real files. each action is
+    # written before it happens and confirmed after, so an interrupted run
+    # can be picked up again with --resume. lines are flushed as they are
+    # written and fsynced in batches to keep the copy loop moving.
+    def __init__(self, path, resume=False, sync_every=100, sync_seconds=2.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+        self.entries = {}
+        if resume and os.path.exists(path):
+            self.replay()
+        mode = "a" if resume else "w"
+        self.handle = open(path, mode, encoding="utf-8")
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+    def replay(self):
+        with open(self.path, encoding="utf-8") as handle:
+            for line in handle:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short by the interruption
+                    continue
+                if record["step"] == "plan":
+                    self.entries[record["src"]] = record
+                elif record["src"] in self.entries:
+                    self.entries[record["src"]]["step"] = "done"
+
+    def write(self, record):
+        self.handle.write(json.dumps(record) + "\n")
+        self.handle.flush()
+        self.unsynced += 1
+        if (self.unsynced >= self.sync_every or
+           time.monotonic() - self.synced_at >= self.sync_seconds):
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.handle.fileno())
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+    def plan(self, action, image, full_name):
+        self.write({"step": "plan", "action": action, "src": image,
+                    "dst": full_name})
+
+    def done(self, image, method=None, content_hash=None):
+        # method is how transfer_file got the file there
+        self.write({"step": "done", "src": image, "method": method,
+                    "hash": content_hash})
+
+    def finish(self):
+        # redo whatever was planned but never confirmed. a copy is simply
+        # done again, a move or delete only if the source is still there.
+        unfinished = 0
+        for image, record in self.entries.items():
+            if record["step"] == "done":
+                continue
+            if record["action"] == "copy" or os.path.exists(image):
+                action_run(record["action"], image, record["dst"])
+            self.done(image)
+            unfinished += 1
+        return (unfinished)
+
+    def commit(self):
+        self.handle.flush()
+        self.sync()
+
+    def close(self):
+        self.commit()
+        self.handle.close()
+
+
+class PlanWriter:
+    # the dry run action list. one buffered handle is kept open for the whole
+    # run instead of reopening camera_copy.csv for every image, and it is
+    # flushed every flush_every rows so progress can still be followed.
+    # paths are written out absolute along with the destination directory,
+    # so --apply-plan doesn't depend on where it is run from or where the
+    # plan is kept.
+    def __init__(self, path, destination, flush_every=500):
+        self.destination = os.path.abspath(destination)
+        self.flush_every = flush_every
+        self.rows = 0
+        self.handle = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.handle, quoting=csv.QUOTE_ALL,
+                                 lineterminator="\n")
+        self.writer.writerow(plan_fields)
+
+    def write(self, action, image, full_name, size="", mtime_ns=""):
+        # size and mtime let --apply-plan spot sources changed since
+        if "DUP of " in full_name:
+            prefix, _, kept = full_name.partition("DUP of ")
+            full_name = f"{prefix}DUP of {os.path.abspath(kept)}"
+        else:
+            full_name = os.path.abspath(full_name)
+        self.writer.writerow((action, os.path.abspath(image), full_name, size,
+                              mtime_ns, self.destination))
+        self.rows += 1
+        if self.rows % self.flush_every == 0:
+            self.handle.flush()
+
+    def commit(self):
+        self.handle.flush()
+
+    def close(self):
+        self.handle.close()
+
+
+def destination_check(full_name, destination):
+    # a layout or a hand edited plan must never send a file outside the
+    # destination, e.g. with an absolute path that os.path.join keeps
+    destination = os.path.abspath(destination)
+    if os.path.commonpath((destination,
+                           os.path.abspath(full_name))) != destination:
+        raise ValueError(f"{full_name} is outside {destination}")
+
+
+def action_parser(image, out_name, destination, destructive, plan=None,
+                  journal=None, size="", mtime_ns="", transfer="auto",
+                  hash_algorithm="md5", verify=False, made_dirs=None,
+                  metrics=None, transfers=None, on_done=None):
+    # a plan means this is a dry run and the action only gets written down.
+    # returns the content hash if one was taken while copying. with a
+    # TransferStage the action is only started, and on_done(content_hash,
+    # stat, seconds) is called once it is done. a NEAR DUP only looks like
+    # the image it matched, so it is never deleted.
+    src_action = "copy"
+    dup_action = "ignore"
+    if destructive:
+        src_action = "move"
+        if not out_name.startswith("NEAR DUP of "):
+            dup_action = "delete"
+    full_name = os.path.join(destination, out_name)
+    if "DUP of" not in out_name:
+        destination_check(full_name, destination)
+    if plan is not None:
+        if "DUP of" in out_name:
+            plan.write(dup_action, image, out_name, size, mtime_ns)
+        else:
+            plan.write(src_action, image, full_name, size, mtime_ns)
+    else:
+        action = src_action
+        if "DUP of" in out_name:
+            action = dup_action
+            full_name = None
+        if journal is not None:
+            journal.plan(action, image, full_name)
+        if transfers is not None and action != "ignore":
+            if full_name is not None:
+                # made here, where two workers can't both be making it
+                dir_ensure(full_name, made_dirs)
+
+            def finished(result, seconds):
+                method, content_hash, stat = result
+                if journal is not None:
+                    journal.done(image, method, content_hash)
+                if metrics is not None:
+                    metrics.transferred(method, size)
+                on_done(content_hash, stat, seconds)
+
+            transfers.submit(transfer_job, (action, image, full_name,
+                                            transfer, hash_algorithm,
+                                            verify), size, finished)
+            return (None)
+        method, content_hash = action_run(action, image, full_name, transfer,
+                                          hash_algorithm, verify, made_dirs)
+        if journal is not None:
+            journal.done(image, method, content_hash)
+        if metrics is not None:
+            metrics.transferred(method, size)
+        if on_done is not None:
+            on_done(content_hash, None, 0)
+        return (content_hash)
+    return (None)
+
+
+def plan_check(plan_path):
+    # goes over the whole plan before anything is done with it, and returns
+    # the destination directory it was made for. raises ValueError naming
+    # the first row that is missing something, points outside the
+    # destination or isn't from a plan at all.
+    destination = None
+    with open(plan_path, newline="", encoding="utf-8") as plan_file:
+        reader = csv.DictReader(plan_file)
+        missing = [field for field in plan_fields
+                   if field not in (reader.fieldnames or ())]
+        if missing:
+            raise ValueError(f"{plan_path} has no {', '.join(missing)} "
+                             "column, make it again with --dry-run")
+        for row in reader:
+            where = f"line {reader.line_num} of {plan_path}"
+            if row["action"] not in plan_actions:
+                raise ValueError(f"{where}: unknown action "
+                                 f"{row['action']!r}")
+            if destination is None:
+                destination = row["destination_dir"]
+            elif row["destination_dir"] != destination:
+                raise ValueError(f"{where}: a different destination, "
+                                 f"{row['destination_dir']}")
+            if not os.path.isabs(row["source"]):
+                raise ValueError(f"{where}: {row['source']} isn't an "
+                                 "absolute path")
+            try:
+                if row["size"]:
+                    int(row["size"]), int(row["mtime_ns"])
+                if "DUP of " not in row["destination"]:
+                    destination_check(row["destination"], destination)
+            except ValueError as error:
+                raise ValueError(f"{where}: {error}")
+    # None for a plan with no rows
+    return (destination)
+
+
+def plan_apply(plan_path, resume=False, transfer="auto", verify=False,
+               metrics=None, transfer_jobs=1):
+    # carries out a plan written by a dry run without searching, hashing or
+    # parsing anything again. each source is only checked against the size
+    # and mtime recorded for it, and a changed source is skipped along with
+    # any deletes of duplicates that relied on it, the same goes for a
+    # source whose destination already exists. transfer_jobs is how many
+    # transfers can be in flight at once, or "auto". raises ValueError from
+    # plan_check, before anything is done, when the plan can't be used.
+    destination = plan_check(plan_path)
+    if destination is None:
+        return (0, 0, 0, 0, 0)
+    journal = Journal(os.path.join(destination, "camera_copy.journal"),
+                      resume)
+    journal.finish()
+    transfers = transfer_stage(transfer_jobs, metrics)
+
+    def finished(image, size, result, seconds):
+        method, content_hash, _ = result
+        journal.done(image, method, content_hash)
+        if metrics is not None:
+            metrics.add("transfer", seconds)
+            metrics.transferred(method, size)
+            metrics.file_done(seconds)
+
+    item_count = 0
+    dup_count = 0
+    move_count = 0
+    changed = set()
+    existing = set()
+    try:
+        with open(plan_path, newline="", encoding="utf-8") as plan_file:
+            for row in csv.DictReader(plan_file):
+                image = row["source"]
+                action = row["action"]
+                item_count += 1
+                if image in journal.entries:
+                    continue
+                try:
+                    stat = os.stat(image)
+                except FileNotFoundError:
+                    changed.add(image)
+                    continue
+                if (row.get("size") and
+                   (stat.st_size != int(row["size"]) or
+                    stat.st_mtime_ns != int(row["mtime_ns"]))):
+                    changed.add(image)
+                    continue
+                full_name = row["destination"]
+                if full_name.startswith(("DUP of ", "NEAR DUP of ")):
+                    dup_count += 1
+                    kept = full_name.partition("DUP of ")[2]
+                    if kept in changed or kept in existing:
+                        continue
+                    full_name = None
+                elif os.path.exists(full_name):
+                    # the destination moved on since the plan was made, or
+                    # the plan was already carried out
+                    existing.add(image)
+                    continue
+                else:
+                    move_count += 1
+                if action == "ignore":
+                    continue
+                start = time.perf_counter()
+                journal.plan(action, image, full_name)
+                if transfers is not None:
+                    if full_name is not None:
+                        dir_ensure(full_name)
+                    transfers.submit(transfer_job,
+                                     (action, image, full_name, transfer,
+                                      "md5", verify), stat.st_size,
+                                     partial(finished, image, stat.st_size))
+                    continue
+                method, content_hash = action_run(action, image, full_name,
+                                                  transfer, verify=verify)
+                finished(image, stat.st_size, (method, content_hash, None),
+                         time.perf_counter() - start)
+    finally:
+        try:
+            if transfers is not None:
+                transfers.close()
+        finally:
+            journal.close()
+    return (item_count, dup_count, move_count, len(changed), len(existing))
@@ -0,0 +1,408 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from . import version
+from .engine import ImageScan, camera_copy
+from .exif_data import exif_header, exif_parse2
+from .hashing import DupIndex, hash_algorithms, hash_file, xxhash_available
+from .naming import (base_name_gen, invalid_chars, name_check, name_template,
+                     path_cleaner, path_cleaner_reference, template_tags)
+from .transfer import transfer_file, transfer_modes
+
+# an 8x8 grey baseline jpeg with its JFIF APP0 segment and SOI cut off, the
+# generated exif segment and any padding go in front of it
+jpeg_body = bytes.fromhex(
+    "ffdb004300100b0c0e0c0a100e0d0e1211101318281a181616183123251d283a333d"
+    "3c3933383740485c4e404457453738506d51575f626768673e4d71797064785c6567"
+    "63ffc0000b080008000801011100ffc4001f00000105010101010101000000000000"
+    "00000102030405060708090a0bffc400b5100002010303020403050504040000017d"
+    "01020300041105122131410613516107227114328191a1082342b1c11552d1f02433"
+    "627282090a161718191a25262728292a3435363738393a434445464748494a535455"
+    "565758595a636465666768696a737475767778797a838485868788898a9293949596"
+    "9798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4"
+    "d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9faffda000801010000"
+    "3f002bffd9")
+
+corpus_makes = {
+    "Canon": ("Canon EOS 5D Mark IV", "Canon EOS R6", "Canon PowerShot G7 X"),
+    "NIKON CORPORATION": ("NIKON D750", "NIKON Z 6"),
+    "Apple": ("iPhone 12 Pro", "iPhone SE (2nd generation)"),
+    "OLYMPUS IMAGING CORP.  ": ("E-M10MarkII",),
+    "FUJIFILM": ("X-T3", "X100V"),
+    "SONY": ("ILCE-7M3", "DSC-RX100M5"),
+}
+corpus_extensions = (".JPG", ".jpg", ".jpeg", ".JPEG")
+
+
+def tiff_ifd(entries, offset, order):
+    # entries are (tag id, type, count, value bytes), anything over four
+    # bytes goes in the data area straight after the ifd
+    data_offset = offset + 2 + (len(entries) * 12) + 4
+    table = len(entries).to_bytes(2, order)
+    data = b""
+    for tag_id, tag_type, count, value in sorted(entries):
+        table += tag_id.to_bytes(2, order) + tag_type.to_bytes(2, order)
+        table += count.to_bytes(4, order)
+        if len(value) > 4:
+            table += (data_offset + len(data)).to_bytes(4, order)
+            data += value
+        else:
+            table += value.ljust(4, b"\x00")
+    return (table + (0).to_bytes(4, order) + data)
+
+
+def exif_segment(main_tags, exif_tags=None, order="little"):
+    # an APP1 segment holding ascii tags, main_tags go in ifd 0 and
+    # exif_tags in the exif sub ifd, both keyed by tag id
+    def ascii_entries(tags):
+        return ([(tag_id, 2, len(value) + 1, value.encode("ascii") + b"\x00")
+                 for tag_id, value in tags.items()])
+
+    entries = ascii_entries(main_tags)
+    sub_ifd = b""
+    if exif_tags:
+        pointer = (0x8769, 4, 1, (0).to_bytes(4, order))
+        main_size = len(tiff_ifd(entries + [pointer], 8, order))
+        pointer = (0x8769, 4, 1, (8 + main_size).to_bytes(4, order))
+        entries.append(pointer)
+        sub_ifd = tiff_ifd(ascii_entries(exif_tags), 8 + main_size, order)
+    mark = b"II" if order == "little" else b"MM"
+    tiff = mark + (42).to_bytes(2, order) + (8).to_bytes(4, order)
+    tiff += tiff_ifd(entries, 8, order) + sub_ifd
+    payload = b"Exif\x00\x00" + tiff
+    return (b"\xff\xe1" + (len(payload) + 2).to_bytes(2, "big") + payload)
+
+
+def padding_segments(rng, size):
+    # comment segments full of noise, to give each file its own content and
+    # a realistic size
+    segments = b""
+    while size > 4:
+        chunk = min(size - 4, 65533)
+        segments += b"\xff\xfe" + (chunk + 2).to_bytes(2, "big")
+        segments += rng.randbytes(chunk)
+        size -= chunk + 4
+    return (segments)
+
+
+def corpus_generate(directory, files=2000, seed=1, dup_every=20,
+                    no_exif_every=10, large_files=4, large_size=8 << 20):
+    # writes the same set of jpegs for the same arguments every time: varied
+    # exif, some without any, a few the tag parser can't read, some
+    # duplicates and some large files. returns (file count, total bytes).
+    rng = random.Random(seed)
+    base_time = 1500000000
+    written = []
+    total = 0
+    for i in range(files):
+        folder = os.path.join(directory, "DCIM", f"{100 + (i // 500)}CAMERA")
+        if i % 3 == 0:
+            folder = os.path.join(folder, f"burst{i % 4}")
+        os.makedirs(folder, exist_ok=True)
+        name = f"IMG_{i:05d}" + rng.choice(corpus_extensions)
+        path = os.path.join(folder, name)
+        mtime = base_time + rng.randrange(0, 200000000)
+        if i and i % dup_every == 0:
+            # a copy of an earlier image under another name
+            with open(rng.choice(written), "rb") as handle:
+                content = handle.read()
+        else:
+            segment = b""
+            if i % no_exif_every != 1:
+                make = rng.choice(sorted(corpus_makes))
+                taken = time.strftime("%Y:%m:%d %H:%M:%S",
+                                      time.gmtime(mtime - 3600))
+                main_tags = {0x010f: make,
+                             0x0110: rng.choice(corpus_makes[make])}
+                if i % 13 != 0:
+                    main_tags[0x0132] = taken
+                segment = exif_segment(main_tags, {0x9003: taken},
+                                       rng.choice(("little", "big")))
+                if i % 97 == 0:
+                    # an ifd offset past the end, the tag parser gives up
+                    # and exif gets the file
+                    segment = segment[:14] + b"\xff\xff" + segment[16:]
+            # sizes come in steps so plenty of files share a size and the
+            # partial hash tier has work to do
+            size = rng.randrange(2, 48) * 1024
+            if i < large_files:
+                size = large_size
+            content = (b"\xff\xd8" + segment + padding_segments(rng, size) +
+                       jpeg_body)
+        with open(path, "wb") as handle:
+            handle.write(content)
+        os.utime(path, (mtime, mtime))
+        written.append(path)
+        total += len(content)
+    # not images, the scan should pass over these
+    with open(os.path.join(directory, "DCIM", "notes.txt"), "w") as handle:
+        handle.write("not an image\n")
+    return (files, total)
+
+
+def stage_time(func, repeat):
+    # runs func repeat times, returns the seconds of every run and what the
+    # last run returned
+    runs = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        runs.append(time.perf_counter() - start)
+    return (runs, result)
+
+
+def stage_result(runs, items, size=None):
+    best = min(runs)
+    result = {"seconds": best, "runs": runs, "items": items,
+              "items_per_sec": items / best if best else None}
+    if size is not None:
+        result["bytes"] = size
+        result["mb_per_sec"] = (size / (1 << 20)) / best if best else None
+    return (result)
+
+
+def bench_run(corpus, repeat=3, template=name_template, transfer="auto",
+              jobs=1, work_dir=None):
+    # times each stage on its own over the images in corpus. the page cache
+    # is warm after enumeration, so these measure the code rather than the
+    # disk. work_dir is where copies are made, a temporary directory by
+    # default.
+    stages = {}
+    runs, images = stage_time(lambda: [entry.path for entry in
+                                       ImageScan(corpus)], repeat)
+    total = sum(os.path.getsize(image) for image in images)
+    stages["enumerate"] = stage_result(runs, len(images))
+
+    tag_names = template_tags(template)
+
+    def parse_all():
+        parsed = []
+        for image in images:
+            with open(image, "rb") as image_handle:
+                exif_content = exif_header(image_handle)
+                if exif_content is None:
+                    image_handle.seek(0)
+                    exif_content = image_handle.read()
+            parsed.append(exif_parse2(exif_content, tag_names, []))
+        return (parsed)
+
+    runs, parsed = stage_time(parse_all, repeat)
+    stages["exif"] = stage_result(runs, len(images))
+
+    def name_all():
+        name_bases = {}
+        return ([name_check(base_name_gen(image, exif_data, template, []),
+                            name_bases)
+                 for image, exif_data in zip(images, parsed)])
+
+    runs, _ = stage_time(name_all, repeat)
+    stages["naming"] = stage_result(runs, len(images))
+
+    names = cleaner_names(len(images))
+    # path_cleaner against the cleaner it replaced
+    for stage, cleaner in (("path_cleaner", path_cleaner),
+                           ("path_cleaner_reference", path_cleaner_reference)):
+        runs, _ = stage_time(lambda: [cleaner(name) for name in names],
+                             repeat)
+        stages[stage] = stage_result(runs, len(names))
+
+    for algorithm in hash_algorithms:
+        if algorithm == "xxhash" and not xxhash_available():
+            continue
+        runs, _ = stage_time(lambda: [hash_file(image, algorithm)
+                                      for image in images], repeat)
+        stages[f"hash_{algorithm}"] = stage_result(runs, len(images), total)
+
+    def dedup_all():
+        dup_list = DupIndex()
+        return (sum(dup_list.check(image) is not None for image in images))
+
+    runs, dup_count = stage_time(dedup_all, repeat)
+    stages["dedup"] = stage_result(runs, len(images), total)
+    stages["dedup"]["duplicates"] = dup_count
+
+    work = tempfile.mkdtemp(prefix="camera_bench_", dir=work_dir)
+    try:
+        def transfer_all():
+            target = tempfile.mkdtemp(dir=work)
+            methods = {}
+            for i, image in enumerate(images):
+                method, _ = transfer_file(image, os.path.join(target,
+                                                              f"{i}.jpg"),
+                                          transfer)
+                methods[method] = methods.get(method, 0) + 1
+            return (methods)
+
+        runs, methods = stage_time(transfer_all, repeat)
+        stages["transfer"] = stage_result(runs, len(images), total)
+        stages["transfer"]["methods"] = methods
+
+        def pipeline():
+            target = tempfile.mkdtemp(dir=work)
+            return (camera_copy(corpus, target, True, False, False, jobs,
+                                progress=lambda text: None))
+
+        runs, counts = stage_time(pipeline, repeat)
+        stages["pipeline"] = stage_result(runs, counts[0], total)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return (stages)
+
+
+def cleaner_names(count, seed=1):
+    # what name_gen2 hands path_cleaner: make_model_datetime from the corpus
+    # cameras, plus strings made up of nothing but the awkward characters
+    rng = random.Random(seed)
+    awkward = "".join(invalid_chars) + "-_aZ0"
+    names = []
+    for i in range(count):
+        if i % 2:
+            names.append("".join(rng.choice(awkward)
+                                 for _ in range(rng.randrange(0, 24))))
+            continue
+        make = rng.choice(sorted(corpus_makes))
+        taken = time.strftime("%Y-%m-%dT%H-%M-%S",
+                              time.gmtime(rng.randrange(0, 2000000000)))
+        names.append("_".join((make, rng.choice(corpus_makes[make]), taken)))
+    return (names)
+
+
+def cleaner_check(count=20000, seed=1):
+    # path_cleaner has to match the cleaner it replaced exactly, returns the
+    # names it doesn't match on. every string of up to four characters is
+    # checked as well as count generated names.
+    mismatches = []
+    alphabet = "".join(invalid_chars) + "-_a"
+    short = [""]
+    for _ in range(4):
+        short = [name + char for name in short for char in alphabet]
+        for name in short:
+            if path_cleaner(name) != path_cleaner_reference(name):
+                mismatches.append(name)
+    for name in cleaner_names(count, seed):
+        if path_cleaner(name) != path_cleaner_reference(name):
+            mismatches.append(name)
+    return (mismatches)
+
+
+def bench_compare(results, baseline):
+    # lines comparing each stage against an earlier results file, a speedup
+    # over 1 means this run was faster
+    lines = []
+    for stage, result in results["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if before is None:
+            continue
+        speedup = before["seconds"] / result["seconds"]
+        lines.append(f"{stage}: {before['seconds']:.4f}s -> "
+                     f"{result['seconds']:.4f}s ({speedup:.2f}x)")
+    return (lines)
+
+
+def bench(corpus=None, files=2000, seed=1, repeat=3, template=name_template,
+          transfer="auto", jobs=1, large_files=4):
+    # the importable entry point. corpus is generated into a temporary
+    # directory unless an existing one is given, an empty or missing corpus
+    # directory is filled in first. returns the results as a dict.
+    scratch = None
+    if corpus is None:
+        scratch = tempfile.mkdtemp(prefix="camera_corpus_")
+        corpus = scratch
+    try:
+        generated = None
+        if not os.path.isdir(corpus) or not os.listdir(corpus):
+            generated = corpus_generate(corpus, files, seed,
+                                        large_files=large_files)
+        stages = bench_run(corpus, repeat, template, transfer, jobs)
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+    results = {
+        "version": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": {"path": None if scratch else corpus, "seed": seed,
+                   "generated": generated is not None,
+                   "files": stages["enumerate"]["items"],
+                   "bytes": stages["pipeline"]["bytes"]},
+        "repeat": repeat,
+        "template": template,
+        "transfer": transfer,
+        "jobs": jobs,
+        "stages": stages,
+    }
+    return (results)
+
+
+def process_args():
+    description = ("Times each stage of camera_copy over a reproducible "
+                   "synthetic corpus, or an existing directory of images, "
+                   "and prints the results as json.")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--corpus",
+                        help=("directory of images to run against, generated "
+                              "there first if it is empty or missing "
+                              "(default: a temporary corpus)"))
+    parser.add_argument("--files", type=int, default=2000,
+                        help="images in a generated corpus (default: 2000)")
+    parser.add_argument("--large-files", type=int, default=4,
+                        help="8MB images in a generated corpus (default: 4)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed for a generated corpus (default: 1)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of each stage, the fastest counts "
+                             "(default: 3)")
+    parser.add_argument("--layout", default=name_template,
+                        help=f"naming template (default: {name_template})")
+    parser.add_argument("--transfer", choices=transfer_modes,
+                        default="auto",
+                        help="transfer mode to time (default: auto)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="worker processes for the pipeline stage "
+                             "(default: 1)")
+    parser.add_argument("--output",
+                        help="write the json here instead of stdout")
+    parser.add_argument("--check-names", action="store_true",
+                        help=("only check path_cleaner gives the same names "
+                              "as the cleaner it replaced, exits 1 if not"))
+    parser.add_argument("--compare", metavar="RESULTS",
+                        help=("an earlier results file to compare against, "
+                              "the comparison goes to stderr"))
+    return (parser.parse_args())
+
+
+def main():
+    args = process_args()
+    if args.check_names:
+        mismatches = cleaner_check(seed=args.seed)
+        for name in mismatches[:20]:
+            print(f"{name!r}: {path_cleaner(name)!r} != "
+                  f"{path_cleaner_reference(name)!r}")
+        print(f"Name Mismatches: {len(mismatches)}")
+        return (1 if mismatches else 0)
+    results = bench(args.corpus, args.files, args.seed, args.repeat,
+                    args.layout, args.transfer, args.jobs, args.large_files)
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as handle:
+            handle.write(output + "\n")
+    else:
+        print(output)
+    if args.compare is not None:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)
+        for line in bench_compare(results, baseline):
+            print(line, file=sys.stderr)
+    return (0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
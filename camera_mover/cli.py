@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+
+from .actions import plan_apply
+from .engine import camera_copy
+from .exif_data import exif_tag_ids
+from .hashing import hash_algorithms, xxhash_available
+from .metrics import Metrics, peak_rss, rss_line
+from .naming import date_fields, name_template, template_tags
+from .perceptual import near_distance, pillow_available
+from .shards import shard_review, shards_merge
+from .transfer import transfer_modes
+
+
+def shard_arg(value):
+    index, _, count = value.partition("/")
+    try:
+        shard = (int(index), int(count))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected I/N, not {value!r}")
+    if not 0 <= shard[0] < shard[1]:
+        raise argparse.ArgumentTypeError("I has to be from 0 to N-1")
+    return (shard)
+
+
+def layout_arg(value):
+    # the template is joined onto the destination, an absolute one or an
+    # empty directory level would put files somewhere else entirely
+    if value.startswith("/") or "" in value.split("/"):
+        raise argparse.ArgumentTypeError("has to be a relative path with no "
+                                         f"empty parts, not {value!r}")
+    # formatted once with stand in values, so a typo fails here rather
+    # than on the first image
+    try:
+        fields = dict.fromkeys(template_tags(value) + date_fields, "x")
+        for part in value.split("/"):
+            part.format(**fields)
+    except (ValueError, KeyError, IndexError, AttributeError) as error:
+        raise argparse.ArgumentTypeError(f"{value!r} isn't a valid template "
+                                         f"({type(error).__name__}: "
+                                         f"{error})")
+    return (value)
+
+
+def transfer_jobs_arg(value):
+    if value == "auto":
+        return (value)
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number or auto, not "
+                                         f"{value!r}")
+    if jobs < 1:
+        raise argparse.ArgumentTypeError("has to be at least 1")
+    return (jobs)
+
+
+def process_args():
+    description = ("A tool to find all jpg images in a directory and copy them"
+                   " to the destination directory with names based on exif "
+                   "data.\n\nIt is recommended to run this against directories"
+                   " where all images are from the same source.")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("source", nargs="*",
+                        help=("directory to search for jpg images, several "
+                              "can be given, e.g. one per card reader, and "
+                              "share one set of names and one duplicate "
+                              "check. sources on different devices are read "
+                              "in parallel and taken a file from each device "
+                              "in turn, so names don't depend on which device "
+                              "is faster"))
+    parser.add_argument("destination", nargs="?",
+                        help="directory for sorted jpg images")
+    parser.add_argument("--skip-dups", action="store_true",
+                        help="check for and skip duplicate images")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="provide an action list instead of copying files")
+    parser.add_argument("--destructive", action="store_true",
+                        help=("move jpg images instead of copying them\nthis "
+                              "option will also delete duplicates when paired "
+                              "with --skip-dups\nThis has no impact if "
+                              "--dry-run has been set"))
+    parser.add_argument("--error-name",
+                        help=("provide a name to prepend to files when exif "
+                              "data cannot be found"))
+    parser.add_argument("--jobs", type=int, default=1,
+                        help=("number of worker processes used to read, hash "
+                              "and parse images (default: 1)"))
+    parser.add_argument("--hash", choices=hash_algorithms, default="md5",
+                        help=("hash used by --skip-dups, xxhash needs the "
+                              "xxhash package (default: md5)"))
+    parser.add_argument("--cache", nargs="?", const="",
+                        help=("keep hashes and exif data in an sqlite file "
+                              "so unchanged files aren't read again on the "
+                              "next run (default: camera_copy_cache.sqlite "
+                              "in the destination)"))
+    parser.add_argument("--near-dups", nargs="?", type=int,
+                        const=near_distance, metavar="DISTANCE",
+                        help=("also skip images that look the same as an "
+                              "earlier one, e.g. re-saved or re-exported "
+                              "copies, going by a perceptual hash of the exif "
+                              "thumbnail. DISTANCE is how many of its 64 "
+                              "bits may differ. these are reported as NEAR "
+                              "DUP and left where they are, they are never "
+                              "deleted, not even with --destructive. an image "
+                              "larger than the one it matches is never "
+                              "skipped. needs the Pillow package "
+                              f"(default: {near_distance})"))
+    parser.add_argument("--resume", action="store_true",
+                        help=("carry on with an interrupted run using the "
+                              "journal it left in the destination"))
+    parser.add_argument("--transfer", choices=transfer_modes,
+                        default="auto",
+                        help=("how files are copied. auto tries a reflink, "
+                              "then kernel side copies, then a plain copy. "
+                              "hardlink links instead of copying when source "
+                              "and destination share a volume. stream hashes "
+                              "files while copying them. moves are a rename "
+                              "whenever possible (default: auto)"))
+    parser.add_argument("--transfer-jobs", type=transfer_jobs_arg, default=1,
+                        metavar="N",
+                        help=("how many copies, moves and deletes can be in "
+                              "flight at once. more than 1 helps a lot when "
+                              "the destination is a network share where "
+                              "every file waits on round trips. auto starts "
+                              "at 8 and follows whatever gives the most "
+                              "throughput. names come out the same either "
+                              "way (default: 1)"))
+    parser.add_argument("--verify", action="store_true",
+                        help=("read every copy back and check it against the "
+                              "hash taken while copying, before anything "
+                              "relies on it or --destructive deletes the "
+                              "source. implies --transfer stream for copies"))
+    parser.add_argument("--layout", type=layout_arg, default=name_template,
+                        help=("template for where images go in the "
+                              "destination, e.g. {year}/{month}/{make}_"
+                              "{model}_{datetime}. fields are year, month, "
+                              "day and the exif tags " +
+                              ", ".join(exif_tag_ids) +
+                              f" (default: {name_template})"))
+    parser.add_argument("--apply-plan", metavar="PLAN",
+                        help=("carry out the camera_copy.csv written by an "
+                              "earlier --dry-run instead of searching "
+                              "source, sources that changed since are "
+                              "skipped. the plan holds absolute paths and its "
+                              "destination, so it can be applied from "
+                              "anywhere, and every row is checked before "
+                              "anything is done"))
+    parser.add_argument("--watch", action="store_true",
+                        help=("keep running after the images already in "
+                              "source and take in each new one as it is "
+                              "dropped there, until ctrl-c. name counts and "
+                              "the duplicate index stay in memory between "
+                              "files. uses inotify on linux and polls "
+                              "elsewhere"))
+    parser.add_argument("--settle", type=float, default=2.0,
+                        metavar="SECONDS",
+                        help=("with --watch, how long a new file has to stay "
+                              "unchanged before it is taken in, so files "
+                              "still being copied are left alone "
+                              "(default: 2)"))
+    parser.add_argument("--poll", action="store_true",
+                        help=("with --watch, poll instead of using inotify, "
+                              "e.g. for network shares where inotify misses "
+                              "changes made by other machines"))
+    parser.add_argument("--shard", type=shard_arg, metavar="I/N",
+                        help=("only review the images a hash of their path "
+                              "puts in shard I of N, e.g. one machine each, "
+                              "and write what was found to a shard file in "
+                              "the destination. nothing is copied, run "
+                              "--merge-shards once every shard is done"))
+    parser.add_argument("--merge-shards", action="store_true",
+                        help=("combine the shard files in the destination "
+                              "into one camera_copy.csv with names and "
+                              "duplicate checks across every shard, to "
+                              "carry out with --apply-plan. images are taken "
+                              "in path order, so the plan is the same for "
+                              "any N but can number or pick duplicates "
+                              "differently from an unsharded run. takes just "
+                              "the destination"))
+    parser.add_argument("--low-memory", action="store_true",
+                        help=("keep the duplicate index and name counts in "
+                              "temporary sqlite files instead of memory, so "
+                              "memory use stays flat on huge runs. slower, "
+                              "and the peak memory used is printed at the "
+                              "end"))
+    parser.add_argument("--stats", action="store_true",
+                        help=("print where the time went: per stage timings, "
+                              "bytes read and written, rates and per file "
+                              "latency"))
+    parser.add_argument("--metrics-json", metavar="PATH",
+                        help="write the --stats numbers to PATH as json")
+    # intermixed, or options between the paths would cut source short and
+    # leave the destination unrecognised
+    args = parser.parse_intermixed_args()
+    # source takes every path given, the last one is the destination
+    if args.destination is None and (len(args.source) > 1 or
+                                     args.merge_shards):
+        args.destination = args.source.pop() if args.source else None
+    if args.apply_plan is None and args.destination is None:
+        parser.error("source and destination are required")
+    if args.hash == "xxhash" and not xxhash_available():
+        parser.error("--hash xxhash needs the xxhash package installed")
+    if args.watch and (args.apply_plan is not None or not args.source):
+        parser.error("--watch needs a source and destination to watch")
+    if args.shard is not None and (args.watch or args.merge_shards or
+                                   args.apply_plan is not None):
+        parser.error("--shard can't be combined with --watch, "
+                     "--merge-shards or --apply-plan")
+    if args.merge_shards and (args.source or args.watch or
+                              args.apply_plan is not None):
+        parser.error("--merge-shards only takes the destination")
+    if args.near_dups is not None and not pillow_available():
+        parser.error("--near-dups needs the Pillow package installed")
+    return (args)
+
+
+def metrics_report(metrics, args):
+    if metrics is None:
+        return
+    metrics.finish()
+    if args.stats:
+        print(metrics.summary())
+    if args.metrics_json is not None:
+        with open(args.metrics_json, "w") as handle:
+            json.dump(metrics.report(), handle, indent=2)
+            handle.write("\n")
+
+
+def main():
+    args = process_args()
+    source = args.source
+    check_dupes = args.skip_dups
+    dry_run = args.dry_run
+    destructive = args.destructive
+    destination = args.destination
+    metrics = None
+    if args.stats or args.metrics_json is not None:
+        metrics = Metrics()
+    if args.apply_plan is not None:
+        try:
+            plan_results = plan_apply(args.apply_plan, args.resume,
+                                      args.transfer, args.verify, metrics,
+                                      args.transfer_jobs)
+        except ValueError as error:
+            print(f"Can't apply plan: {error}")
+            return (1)
+        output = (f'Files Processed: {plan_results[0]}\n'
+                  f'Duplicates Skipped: {plan_results[1]}\n'
+                  f'Files "Moved": {plan_results[2]}\n'
+                  f'Sources Changed: {plan_results[3]}\n'
+                  f'Destinations Existing: {plan_results[4]}\n')
+        print(output)
+        metrics_report(metrics, args)
+        return (0)
+    if args.merge_shards:
+        try:
+            merge_results = shards_merge(destination, check_dupes,
+                                         destructive, args.hash,
+                                         args.near_dups, args.low_memory)
+        except ValueError as error:
+            print(f"Can't merge: {error}")
+            return (1)
+        output = (f'Files Processed: {merge_results[0]}\n'
+                  f'Duplicates Skipped: {merge_results[1]}\n'
+                  f'Plan: {os.path.join(destination, "camera_copy.csv")}\n')
+        print(output)
+        metrics_report(metrics, args)
+        return (0)
+    cache_path = args.cache
+    if cache_path == "":
+        cache_path = os.path.join(destination, "camera_copy_cache.sqlite")
+    if args.shard is not None:
+        shard_results = shard_review(source, destination, args.shard,
+                                     check_dupes, args.jobs, args.hash,
+                                     cache_path, args.layout,
+                                     args.near_dups is not None,
+                                     args.low_memory, metrics=metrics)
+        output = (f'Files Reviewed: {shard_results[0]}\n'
+                  f'Duplicates In Shard: {shard_results[1]}\n')
+        print(output)
+        metrics_report(metrics, args)
+        return (0)
+    camera_results = camera_copy(source, destination, check_dupes, destructive,
+                                 dry_run, args.jobs, args.hash, cache_path,
+                                 args.resume, args.transfer, args.verify,
+                                 args.layout, metrics=metrics,
+                                 low_memory=args.low_memory,
+                                 near_dups=args.near_dups,
+                                 watch=args.watch, settle=args.settle,
+                                 poll=args.poll,
+                                 transfer_jobs=args.transfer_jobs)
+    output = (f'Files Processed: {camera_results[0]}\n'
+              f'Duplicates Skipped: {camera_results[1]}\n'
+              f'Files "Moved": {camera_results[2]}\n')
+    print(output)
+    metrics_report(metrics, args)
+    if args.low_memory and not args.stats:
+        own_rss, worker_rss = peak_rss()
+        if own_rss is not None:
+            print(rss_line(own_rss, worker_rss))
+    return (0)
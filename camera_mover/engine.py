@@ -0,0 +1,444 @@
+import math
+import os
+import re
+import time
+from collections import deque
+from functools import partial
+
+from .actions import Journal, PlanWriter, action_parser
+from .exif_data import exif_header, exif_parse2
+from .hashing import DiskDupIndex, DupIndex, path_shard
+from .index import ArchiveIndex, MetaCache
+from .naming import (DiskNameCounts, base_name_gen, name_check, name_template,
+                     template_tags)
+from .perceptual import image_phash, near_index_new
+from .transfer import transfer_stage
+
+image_pattern = re.compile("(JP|jp)((eg|EG)|G|g)$")
+
+
+def image_listing2(directory):
+    listing = []
+    for p, d, f in os.walk(directory):
+        for file in f:
+            if re.match(".*(JP|jp)((eg|EG)|G|g)$", file):
+                full_path = os.path.join(p, file)
+                listing.append(full_path)
+    return (listing)
+
+
+class ImageScan:
+    # streams the images under directory as os.DirEntry objects, in the same
+    # order os.walk would list them, so processing can start on the first
+    # one straight away. found is a running count for progress reporting and
+    # anything in exclude is passed over. shard is (index, count) to only
+    # list the images path_shard puts in shard index.
+    def __init__(self, directory, exclude=(), shard=None):
+        self.directory = directory
+        self.exclude = exclude
+        self.shard = shard
+        self.found = 0
+
+    def __iter__(self):
+        return (self.scan(self.directory))
+
+    def scan(self, directory):
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        # like os.walk, symlinked directories aren't followed
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif (image_pattern.search(entry.name) and
+                          entry.path not in self.exclude and
+                          self.in_shard(entry.path)):
+                        self.found += 1
+                        yield (entry)
+        except OSError:
+            # os.walk skips directories it can't read as well
+            return
+        for subdir in subdirs:
+            yield from self.scan(subdir)
+
+    def in_shard(self, path):
+        if self.shard is None:
+            return (True)
+        index, count = self.shard
+        relative = os.path.relpath(path, self.directory)
+        return (path_shard(relative, count) == index)
+
+
+def image_review(image, template=name_template, near_dups=False):
+    # everything in here only depends on the image itself, so it is safe to
+    # hand off to a worker pool. naming and duplicate tracking depend on the
+    # order of the images and stay in list_review. errors holds the class
+    # names of anything that went wrong reading the exif, a worker process
+    # can't hand those to a callback itself. timings is the bytes read and
+    # the seconds spent in each stage, for Metrics. the perceptual hash is
+    # only worked out for near_dups.
+    errors = []
+    start = time.perf_counter()
+    with open(image, "rb") as image_handle:
+        stat = os.fstat(image_handle.fileno())
+        exif_content = exif_header(image_handle)
+        if exif_content is None:
+            # not something the marker walk understands, let exif have a go
+            # at the whole file like it always did
+            image_handle.seek(0)
+            exif_content = image_handle.read()
+    read_end = time.perf_counter()
+    exif_data = exif_parse2(exif_content, template_tags(template), errors)
+    parse_end = time.perf_counter()
+    base_name = base_name_gen(image, exif_data, template, errors)
+    name_end = time.perf_counter()
+    stages = {"read": read_end - start, "exif": parse_end - read_end,
+              "naming": name_end - parse_end}
+    phash = None
+    if near_dups:
+        phash = image_phash(image, exif_content)
+        stages["phash"] = time.perf_counter() - name_end
+    return (image, stat.st_size, stat.st_mtime_ns, exif_data, base_name,
+            errors, (len(exif_content), stages), phash)
+
+
+def image_reviews(images, executor=None, cache=None, window=64,
+                  template=name_template, metrics=None, near_dups=False):
+    # yields image_review results in the order images come in. images the
+    # cache already knows about are answered from a stat without being
+    # opened. with an executor up to window images are in flight at once,
+    # images is only read as far ahead as that needs. a None in images means
+    # there is nothing more for now, like DirWatcher between new files, so
+    # everything in flight is handed back instead of waiting on the next
+    # image. time spent waiting on the workers goes to metrics.
+    tag_names = template_tags(template)
+    pending = deque()
+    if executor is None:
+        window = 0
+
+    def finish(review):
+        if not isinstance(review, tuple):
+            if isinstance(review, str):
+                review = image_review(review, template, near_dups)
+            elif metrics is not None:
+                start = time.perf_counter()
+                review = review.result()
+                metrics.add("wait", time.perf_counter() - start)
+            else:
+                review = review.result()
+            if cache is not None:
+                cache.exif_set(*review[:3], tag_names, review[3])
+                if review[7] is not None:
+                    cache.hash_set(*review[:3], "phash", "dhash",
+                                   f"{review[7]:016x}")
+        return (review)
+
+    for image in images:
+        if image is None:
+            while pending:
+                yield (finish(pending.popleft()))
+            continue
+        path = os.fspath(image)
+        cached = None
+        if cache is not None:
+            start = time.perf_counter()
+            if isinstance(image, os.DirEntry):
+                stat = image.stat()
+            else:
+                stat = os.stat(path)
+            exif_data = cache.exif_get(path, stat.st_size, stat.st_mtime_ns,
+                                       tag_names)
+            phash = None
+            if exif_data is not None and near_dups:
+                phash = cache.hash_get(path, stat.st_size, stat.st_mtime_ns,
+                                       "phash", "dhash")
+                if phash is None:
+                    # has to be opened for the perceptual hash anyway
+                    exif_data = None
+                else:
+                    phash = int(phash, 16)
+            lookup_end = time.perf_counter()
+            if exif_data is not None:
+                errors = []
+                base_name = base_name_gen(path, exif_data, template, errors)
+                timings = (0, {"cache": lookup_end - start,
+                               "naming": time.perf_counter() - lookup_end})
+                cached = (path, stat.st_size, stat.st_mtime_ns, exif_data,
+                          base_name, errors, timings, phash)
+            elif metrics is not None:
+                metrics.add("cache", lookup_end - start)
+        if cached is not None:
+            pending.append(cached)
+        elif executor is not None:
+            pending.append(executor.submit(image_review, path, template,
+                                           near_dups))
+        else:
+            pending.append(path)
+        while len(pending) > window:
+            yield (finish(pending.popleft()))
+    while pending:
+        yield (finish(pending.popleft()))
+
+
+def print_progress(text):
+    print(text, end="\r")
+
+
+def list_review(image_list, check_dup, destination, destructive, plan=None,
+                jobs=1, hash_algorithm="md5", cache=None, archive=None,
+                journal=None, transfer="auto", verify=False,
+                layout=name_template, progress=print_progress, cancel=None,
+                on_error=None, metrics=None, low_memory=False,
+                near_dups=None, transfer_jobs=1):
+    # progress is handed a status line for every image. cancel is checked
+    # between images, so stopping leaves every file either fully handled or
+    # untouched. on_error(image, error) is called for each exif problem of
+    # an image that isn't a duplicate. metrics collects the time spent in
+    # each stage. low_memory keeps the name counts and duplicate index in
+    # temporary sqlite files instead of memory. near_dups is how many bits
+    # apart perceptual hashes can be for images to count as duplicates,
+    # None to only skip exact copies. transfer_jobs is how many transfers
+    # can be in flight at once, or "auto" to find out as it goes.
+    if low_memory:
+        name_bases = DiskNameCounts()
+        dup_list = DiskDupIndex(hash_algorithm, cache=cache)
+    else:
+        name_bases = {}
+        dup_list = DupIndex(hash_algorithm, cache=cache)
+    near_list = None
+    if near_dups is not None:
+        near_list = near_index_new(near_dups)
+    made_dirs = set()
+    if archive is not None:
+        archive.load(name_bases, dup_list if check_dup else None, near_list)
+    item_count = 0
+    dup_count = 0
+    item_total = None
+    if hasattr(image_list, "__len__"):
+        item_total = len(image_list)
+    executor = None
+    if jobs > 1:
+        # only needed with workers, and slow to import on some platforms
+        from concurrent.futures import ProcessPoolExecutor
+        # results are handed back in image_list order, which keeps the _001
+        # suffixes identical to a serial run
+        executor = ProcessPoolExecutor(max_workers=jobs)
+    images = image_list
+    if metrics is not None:
+        images = metrics.timed("scan", image_list)
+    if hasattr(image_list, "reviews"):
+        # a DeviceScan reads from several devices at once
+        reviews = image_list.reviews(executor, cache, template=layout,
+                                     metrics=metrics,
+                                     near_dups=near_list is not None)
+    else:
+        reviews = image_reviews(images, executor, cache, template=layout,
+                                metrics=metrics,
+                                near_dups=near_list is not None)
+    transfers = None
+    if plan is None:
+        transfers = transfer_stage(transfer_jobs, metrics)
+    if transfers is not None and hasattr(image_list, "on_idle"):
+        # a DirWatcher going idle, everything in flight is finished and
+        # filed before whatever it does then
+        watch_idle = image_list.on_idle
+
+        def idle():
+            transfers.join()
+            if watch_idle is not None:
+                watch_idle()
+
+        image_list.on_idle = idle
+
+    def filed(image, size, out_name, phash, seconds, content_hash=None,
+              stat=None, transfer_seconds=0):
+        # what is left once the action for image is done, straight after it
+        # or from transfers once it finishes. out_name is None when nothing
+        # went into the destination and seconds is the time already spent.
+        start = time.perf_counter()
+        if out_name is not None:
+            full_name = os.path.join(destination, out_name)
+            if content_hash is not None and check_dup:
+                dup_list.learn(image, size, content_hash)
+            if destructive:
+                dup_list.relocate(image, size, full_name)
+            if archive is not None:
+                if stat is None:
+                    stat = os.stat(full_name)
+                archive.add(out_name, stat.st_size, stat.st_mtime_ns,
+                            full=content_hash, phash=phash)
+        if metrics is not None:
+            end = time.perf_counter()
+            if transfer_seconds:
+                metrics.add("transfer", transfer_seconds)
+            if archive is not None:
+                metrics.add("index", end - start)
+            metrics.file_done(seconds + transfer_seconds + end - start)
+
+    try:
+        for review in reviews:
+            (image, size, mtime_ns, exif_data, base_name, errors, timings,
+             phash) = review
+            if cancel is not None and cancel.is_set():
+                break
+            start = time.perf_counter()
+            item_count += 1
+            if item_total is not None:
+                percent = math.floor((item_count / item_total) * 100)
+                progress(f"Processing: {item_count} of {item_total}"
+                         f"({percent}%)")
+            else:
+                # a streamed listing only knows how many it has found so far
+                found = getattr(image_list, "found", item_count)
+                progress(f"Processing: {item_count} of {found} found")
+            dup_of = None
+            if check_dup:
+                if transfers is not None and destructive:
+                    # a move of a file this size could still be under way
+                    transfers.wait_size(size)
+                dup_of = dup_list.check(image, size, mtime_ns)
+            near_of = None
+            if dup_of is None and near_list is not None and phash is not None:
+                near_of = dup_of = near_list.check(image, phash, size)
+            dedup_end = time.perf_counter()
+            if dup_of is None:
+                if on_error is not None:
+                    for error in errors:
+                        on_error(image, error)
+                out_name = name_check(base_name, name_bases)
+            elif near_of is not None:
+                # only looks the same, action_parser leaves it in place
+                dup_count += 1
+                out_name = f"NEAR DUP of {near_of}"
+            else:
+                dup_count += 1
+                out_name = f"DUP of {dup_of}"
+            name_end = time.perf_counter()
+            review_seconds = sum(timings[1].values()) + name_end - start
+            on_done = None
+            if transfers is not None:
+                on_done = partial(filed, image, size,
+                                  out_name if dup_of is None else None,
+                                  phash, review_seconds)
+            content_hash = action_parser(image, out_name, destination,
+                                         destructive, plan, journal, size,
+                                         mtime_ns, transfer, hash_algorithm,
+                                         verify, made_dirs, metrics,
+                                         transfers, on_done)
+            action_end = time.perf_counter()
+            if transfers is None:
+                filed(image, size,
+                      out_name if dup_of is None and plan is None else None,
+                      phash, review_seconds + action_end - name_end,
+                      content_hash)
+            if metrics is not None:
+                metrics.bytes_read += timings[0]
+                for stage, seconds in timings[1].items():
+                    metrics.add(stage, seconds)
+                if check_dup or near_list is not None:
+                    metrics.add("dedup", dedup_end - start)
+                # numbering happens here, the rest of naming in image_review
+                metrics.add("naming", name_end - dedup_end, 0)
+                if transfers is None:
+                    metrics.add("plan" if plan is not None else "transfer",
+                                action_end - name_end)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        try:
+            if transfers is not None:
+                # whatever is in flight is finished and filed
+                transfers.close()
+        finally:
+            if archive is not None:
+                archive.close(dup_list)
+            if metrics is not None:
+                metrics.bytes_read += dup_list.bytes_read
+            dup_list.close()
+            if low_memory:
+                name_bases.close()
+    if progress is print_progress:
+        print(f"")
+    # every image gets an action, duplicates included
+    return (item_count, dup_count, item_count)
+
+
+def camera_copy(src, dst, dup=False, destructive=False, dry_run=True,
+                jobs=1, hash_algorithm="md5", cache_path=None, resume=False,
+                transfer="auto", verify=False, layout=name_template,
+                progress=print_progress, cancel=None, on_error=None,
+                metrics=None, low_memory=False, near_dups=None, watch=False,
+                settle=2.0, poll=False, transfer_jobs=1):
+    # src is a directory or a list of them, all sharing one set of names
+    # and one duplicate index. watch keeps going after the images already
+    # there, taking each new one as it turns up until cancel is set or
+    # ctrl-c, with the name counts and duplicate index carried over. settle
+    # is how long a new file has to stay unchanged first, poll skips
+    # inotify. transfer_jobs is how many transfers can be in flight at
+    # once, or "auto".
+    sources = src
+    if isinstance(src, (str, os.PathLike)):
+        sources = [src]
+    journal = None
+    if not dry_run:
+        journal = Journal(os.path.join(dst, "camera_copy.journal"), resume)
+        unfinished = journal.finish()
+        if unfinished:
+            progress(f"Finished {unfinished} interrupted actions")
+            if progress is print_progress:
+                # kept on screen rather than written over by the next line
+                print(f"")
+    # anything in the journal was dealt with by the interrupted run
+    exclude = ()
+    if journal is not None:
+        exclude = journal.entries
+    if watch:
+        # only needed for --watch
+        from .watch import DirWatcher
+        images = DirWatcher(sources, exclude, (dst,), settle, cancel=cancel,
+                            poll=poll)
+    elif len(sources) > 1:
+        # only needed for several sources
+        from .sources import DeviceScan
+        images = DeviceScan(sources, exclude)
+    else:
+        images = ImageScan(sources[0], exclude)
+    plan = None
+    if dry_run:
+        plan = PlanWriter(os.path.join(dst, "camera_copy.csv"), dst)
+    cache = None
+    if cache_path is not None:
+        cache = MetaCache(cache_path)
+    try:
+        start = time.perf_counter()
+        archive = ArchiveIndex(dst, hash_algorithm)
+        if metrics is not None:
+            metrics.add("index", time.perf_counter() - start, 0)
+        if watch:
+            def idle():
+                # nothing is in flight, get everything so far on disk in
+                # case the watch is never stopped cleanly
+                archive.commit()
+                for output in (plan, cache, journal):
+                    if output is not None:
+                        output.commit()
+
+            images.on_idle = idle
+        list_counts = list_review(images, dup, dst, destructive, plan,
+                                  jobs, hash_algorithm, cache, archive,
+                                  journal, transfer, verify, layout,
+                                  progress, cancel, on_error, metrics,
+                                  low_memory, near_dups, transfer_jobs)
+    finally:
+        if plan is not None:
+            plan.close()
+        if cache is not None:
+            cache.close()
+        if journal is not None:
+            journal.close()
+    return (list_counts)
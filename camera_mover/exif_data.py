@@ -0,0 +1,201 @@
+import os
+import sys
+
+# ascii tags a naming template can use, as (ifd, tag id). ifd 0 is the main
+# image ifd, ifd 1 is the exif sub ifd it points to.
+exif_tag_ids = {
+    "make": (0, 0x010f),
+    "model": (0, 0x0110),
+    "software": (0, 0x0131),
+    "datetime": (0, 0x0132),
+    "artist": (0, 0x013b),
+    "datetime_original": (1, 0x9003),
+    "datetime_digitized": (1, 0x9004),
+    "body_serial_number": (1, 0xa431),
+    "lens_model": (1, 0xa434),
+}
+
+
+class HiddenPrints:
+    def __enter__(self):
+        self._original_stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        sys.stderr.close()
+        sys.stderr = self._original_stderr
+
+
+def exif_header(image_handle, read_size=65536):
+    # walks the jpeg marker segments at the start of the file and returns a
+    # minimal jpeg (SOI, the exif APP1 segment, EOI) that exif.Image can parse.
+    # usually only the first read_size bytes are needed. returns None when the
+    # file doesn't look like a jpeg so the caller can fall back to read().
+    head = image_handle.read(read_size)
+
+    def fill(size):
+        nonlocal head
+        if len(head) < size:
+            head += image_handle.read(max(size - len(head), read_size))
+        return (len(head) >= size)
+
+    if head[:2] != b"\xff\xd8":
+        return (None)
+    pos = 2
+    while fill(pos + 4):
+        if head[pos] != 0xff:
+            return (None)
+        marker = head[pos + 1]
+        if marker == 0xff:
+            # fill byte before a marker
+            pos += 1
+        elif marker == 0x01 or 0xd0 <= marker <= 0xd7:
+            # standalone markers have no length
+            pos += 2
+        elif marker in (0xd9, 0xda):
+            # reached the image data without finding any exif
+            return (b"\xff\xd8\xff\xd9")
+        else:
+            seg_end = pos + 2 + int.from_bytes(head[pos + 2:pos + 4], "big")
+            if marker == 0xe1 and fill(pos + 10):
+                if head[pos + 4:pos + 10] == b"Exif\x00\x00":
+                    if not fill(seg_end):
+                        return (None)
+                    return (b"\xff\xd8" + head[pos:seg_end] + b"\xff\xd9")
+            pos = seg_end
+    return (None)
+
+
+def exif_tiff(exif_content):
+    # the tiff structure inside the minimal jpeg from exif_header, and
+    # uint(offset, size) to read its integers in the right byte order.
+    # uint raises ValueError past the end. None when there's no usable
+    # exif segment.
+    if (exif_content[2:4] != b"\xff\xe1" or
+       exif_content[6:12] != b"Exif\x00\x00"):
+        return (None)
+    tiff = exif_content[12:-2]
+    order = {b"II": "little", b"MM": "big"}.get(tiff[:2])
+    if order is None:
+        return (None)
+
+    def uint(offset, size):
+        if offset + size > len(tiff):
+            raise ValueError("exif offset out of range")
+        return (int.from_bytes(tiff[offset:offset + size], order))
+
+    return (tiff, uint)
+
+
+def exif_tag_parse(exif_content, tag_names):
+    # decodes only the ascii tags in tag_names straight out of the tiff
+    # structure instead of having exif decode every tag in the file. expects
+    # the minimal jpeg from exif_header. returns 1 when there is no exif and
+    # None when anything looks off, so exif can take over.
+    if exif_content == b"\xff\xd8\xff\xd9":
+        return (1)
+    parsed = exif_tiff(exif_content)
+    if parsed is None:
+        return (None)
+    tiff, uint = parsed
+    wanted = {}
+    for tag in tag_names:
+        if tag in exif_tag_ids:
+            wanted[exif_tag_ids[tag]] = tag
+    exif_dict = {}
+    try:
+        ifd_offsets = {0: uint(4, 4)}
+        for ifd in (0, 1):
+            if ifd not in ifd_offsets:
+                break
+            if not any(key[0] == ifd for key in wanted):
+                continue
+            offset = ifd_offsets[ifd]
+            for i in range(uint(offset, 2)):
+                entry = offset + 2 + (i * 12)
+                tag_id = uint(entry, 2)
+                if ifd == 0 and tag_id == 0x8769:
+                    ifd_offsets[1] = uint(entry + 8, 4)
+                if (ifd, tag_id) not in wanted or uint(entry + 2, 2) != 2:
+                    continue
+                count = uint(entry + 4, 4)
+                value_offset = entry + 8
+                if count > 4:
+                    value_offset = uint(entry + 8, 4)
+                if value_offset + count > len(tiff):
+                    raise ValueError("exif value out of range")
+                value = tiff[value_offset:value_offset + count]
+                try:
+                    value = value.split(b"\x00", 1)[0].decode("ascii")
+                except UnicodeDecodeError:
+                    # exif leaves undecodable tags out of get_all too
+                    continue
+                exif_dict[wanted[(ifd, tag_id)]] = value
+    except ValueError:
+        return (None)
+    return (exif_dict)
+
+
+def exif_thumbnail(exif_content):
+    # the jpeg thumbnail ifd 1 points to, out of the minimal jpeg from
+    # exif_header, or None when there isn't one
+    parsed = exif_tiff(exif_content)
+    if parsed is None:
+        return (None)
+    tiff, uint = parsed
+    try:
+        main_ifd = uint(4, 4)
+        thumb_ifd = uint(main_ifd + 2 + (uint(main_ifd, 2) * 12), 4)
+        if not thumb_ifd:
+            return (None)
+        start = size = None
+        for i in range(uint(thumb_ifd, 2)):
+            entry = thumb_ifd + 2 + (i * 12)
+            tag_id = uint(entry, 2)
+            if tag_id == 0x0201:
+                start = uint(entry + 8, 4)
+            elif tag_id == 0x0202:
+                size = uint(entry + 8, 4)
+    except ValueError:
+        return (None)
+    if not start or not size or start + size > len(tiff):
+        return (None)
+    thumbnail = tiff[start:start + size]
+    if thumbnail[:2] != b"\xff\xd8":
+        return (None)
+    return (thumbnail)
+
+
+def get_full_class_name(obj):
+    # source: https://stackoverflow.com/a/58045927/3957324
+    module = obj.__class__.__module__
+    if module is None or module == str.__class__.__module__:
+        return obj.__class__.__name__
+    return module + '.' + obj.__class__.__name__
+
+
+def exif_parse2(file_content, tag_names=None, errors=None):
+    # errors collects the class names of anything exif raised
+    if tag_names is not None:
+        exif_dict = exif_tag_parse(file_content, tag_names)
+        if exif_dict is not None:
+            return (exif_dict)
+    # exif is only needed for files the tag parser gives up on, so it isn't
+    # imported until then
+    import exif
+    try:
+        exif_object = exif.Image(file_content)
+    except Exception as e:
+        if errors is None:
+            raise
+        errors.append(get_full_class_name(e))
+        return (1)
+    if exif_object.has_exif:
+        with HiddenPrints():
+            exif_dict = exif_object.get_all()
+        if tag_names is not None:
+            exif_dict = {tag: exif_dict[tag] for tag in tag_names
+                         if tag in exif_dict}
+        return (exif_dict)
+    else:
+        return (1)
@@ -0,0 +1,282 @@
+import hashlib
+import importlib.util
+import os
+import sqlite3
+import threading
+
+hash_algorithms = ("md5", "blake2b", "xxhash")
+hash_chunk_size = 1024 * 1024
+hash_buffers = threading.local()
+
+
+def xxhash_available():
+    return (importlib.util.find_spec("xxhash") is not None)
+
+
+def hash_new(algorithm):
+    if algorithm == "xxhash":
+        # optional, and only imported when it is actually asked for
+        import xxhash
+        return (xxhash.xxh3_128())
+    return (hashlib.new(algorithm))
+
+
+def chunk_buffer():
+    # one buffer per thread, reused for every file it reads through
+    try:
+        return (hash_buffers.buffer)
+    except AttributeError:
+        hash_buffers.buffer = bytearray(hash_chunk_size)
+        return (hash_buffers.buffer)
+
+
+def hash_stream(handle, algorithm="md5"):
+    # hashes in fixed size chunks through one reused buffer per thread, so
+    # memory use stays flat no matter how big the file is
+    buffer = chunk_buffer()
+    view = memoryview(buffer)
+    hasher = hash_new(algorithm)
+    size = handle.readinto(buffer)
+    while size:
+        hasher.update(view[:size])
+        size = handle.readinto(buffer)
+    return (hasher.hexdigest())
+
+
+def hash_file(name, algorithm="md5"):
+    with open(name, "rb") as handle:
+        return (hash_stream(handle, algorithm))
+
+
+def path_shard(path, count):
+    # which of count shards path belongs to. path should be relative to the
+    # source it was found in, so machines that mount a shared tree in
+    # different places still split it the same way.
+    key = path.replace(os.sep, "/").encode("utf-8", "surrogateescape")
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return (int.from_bytes(digest, "big") % count)
+
+
+def dup_check(name, md5_hashes, algorithm="md5"):
+    content_hash = hash_file(name, algorithm)
+    try:
+        if md5_hashes[content_hash]:
+            return_code = content_hash
+    except KeyError:
+        return_code = 0
+        md5_hashes[content_hash] = name
+    return (return_code)
+
+
+def dup_check2(name, content, md5_hashes):
+    content_hash = hashlib.md5(content).hexdigest()
+    try:
+        if md5_hashes[content_hash]:
+            return_code = content_hash
+    except KeyError:
+        return_code = 0
+        md5_hashes[content_hash] = name
+    return (return_code)
+
+
+class DupIndex:
+    # tiered duplicate lookup. files are grouped by size and only read when
+    # another file of the same size turns up: first a hash of the first and
+    # last few KB, then a full hash if those match as well. the first file
+    # seen with some content is the one later duplicates point to. hashes
+    # are kept as binary digests and handed in and out as hex.
+    def __init__(self, algorithm="md5", edge_size=4096, cache=None):
+        self.algorithm = algorithm
+        self.edge_size = edge_size
+        self.cache = cache
+        self.sizes = {}
+        # what hashing has read so far, for Metrics
+        self.bytes_read = 0
+
+    def group(self, size):
+        # the entries with size, the storage side is all in group, insert,
+        # update and entries so DiskDupIndex can keep them somewhere else
+        return (self.sizes.get(size, ()))
+
+    def insert(self, entry):
+        try:
+            self.sizes[entry["size"]].append(entry)
+        except KeyError:
+            self.sizes[entry["size"]] = [entry]
+
+    def update(self, entry, field):
+        # entries here are the stored dicts themselves, nothing to write back
+        return
+
+    def entries(self):
+        for group in self.sizes.values():
+            yield from group
+
+    def cached_hash(self, entry, kind, hash_func):
+        if entry[kind] is not None:
+            return (entry[kind])
+        if self.cache is not None and entry["mtime_ns"] is not None:
+            key = (entry["name"], entry["size"], entry["mtime_ns"])
+            content_hash = self.cache.hash_get(*key, kind, self.algorithm)
+            if content_hash is None:
+                entry[kind] = hash_func(entry)
+                self.cache.hash_set(*key, kind, self.algorithm,
+                                    entry[kind].hex())
+            else:
+                entry[kind] = bytes.fromhex(content_hash)
+        else:
+            entry[kind] = hash_func(entry)
+        self.update(entry, kind)
+        return (entry[kind])
+
+    def partial_hash(self, entry):
+        return (self.cached_hash(entry, "partial", self.edge_hash))
+
+    def full_hash(self, entry):
+        return (self.cached_hash(entry, "full", self.file_hash))
+
+    def edge_hash(self, entry):
+        hasher = hash_new(self.algorithm)
+        with open(entry["path"], "rb") as handle:
+            hasher.update(handle.read(self.edge_size))
+            if entry["size"] > self.edge_size:
+                handle.seek(max(self.edge_size,
+                                entry["size"] - self.edge_size))
+                hasher.update(handle.read(self.edge_size))
+        self.bytes_read += min(entry["size"], self.edge_size * 2)
+        return (hasher.digest())
+
+    def file_hash(self, entry):
+        self.bytes_read += entry["size"]
+        return (bytes.fromhex(hash_file(entry["path"], self.algorithm)))
+
+    def add(self, name, size, mtime_ns=None, partial=None, full=None,
+            archived=False):
+        # records name as the first file of its content without checking it
+        if partial is not None:
+            partial = bytes.fromhex(partial)
+        if full is not None:
+            full = bytes.fromhex(full)
+        entry = {"name": name, "path": name, "size": size,
+                 "mtime_ns": mtime_ns, "partial": partial, "full": full,
+                 "archived": archived}
+        self.insert(entry)
+        return (entry)
+
+    def check(self, name, size=None, mtime_ns=None, partial=None,
+              full=None):
+        # returns the earlier file name has the same content as, or None
+        # after recording name as the first of its content. partial and
+        # full are hashes of name already worked out elsewhere, if any.
+        if size is None:
+            size = os.path.getsize(name)
+        if partial is not None:
+            partial = bytes.fromhex(partial)
+        if full is not None:
+            full = bytes.fromhex(full)
+        entry = {"name": name, "path": name, "size": size,
+                 "mtime_ns": mtime_ns, "partial": partial, "full": full,
+                 "archived": False}
+        group = self.group(size)
+        if not group:
+            self.insert(entry)
+            return (None)
+        for other in group:
+            if self.partial_hash(entry) != self.partial_hash(other):
+                continue
+            # the partial hash already covered all of a small file
+            if size <= self.edge_size * 2:
+                return (other["name"])
+            if self.full_hash(entry) == self.full_hash(other):
+                return (other["name"])
+        self.insert(entry)
+        return (None)
+
+    def hashes(self, name, size):
+        # the partial and full hash, as hex, of name or of the file it is a
+        # duplicate of. the partial hash is worked out if it hasn't been
+        # yet, the full one is None unless something needed it.
+        for entry in self.group(size):
+            if entry["name"] == name:
+                partial = self.partial_hash(entry).hex()
+                full = entry["full"]
+                if full is not None:
+                    full = full.hex()
+                return (partial, full)
+        return (None, None)
+
+    def learn(self, name, size, full):
+        # a full hash worked out elsewhere, e.g. while copying name
+        for entry in self.group(size):
+            if entry["name"] == name and entry["full"] is None:
+                entry["full"] = bytes.fromhex(full)
+                self.update(entry, "full")
+                if self.cache is not None and entry["mtime_ns"] is not None:
+                    self.cache.hash_set(name, size, entry["mtime_ns"],
+                                        "full", self.algorithm, full)
+
+    def relocate(self, name, size, path):
+        # name was moved, its hashes have to be read from path from now on.
+        # duplicates are still reported against name.
+        for entry in self.group(size):
+            if entry["name"] == name:
+                entry["path"] = path
+                self.update(entry, "path")
+
+    def close(self):
+        return
+
+
+class DiskDupIndex(DupIndex):
+    # a DupIndex that keeps its entries in a throwaway sqlite file rather
+    # than in memory, for --low-memory. only the entries of one size are
+    # ever loaded at a time, so memory stays flat however many files there
+    # are, at the cost of a lookup and an insert per file.
+    fields = ("name", "path", "size", "mtime_ns", "partial", "full",
+              "archived")
+
+    def __init__(self, algorithm="md5", edge_size=4096, cache=None,
+                 path=""):
+        super().__init__(algorithm, edge_size, cache)
+        # an empty path is a temporary file sqlite removes on close
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE entries (id INTEGER PRIMARY KEY, "
+                        "name TEXT, path TEXT, size INTEGER, "
+                        "mtime_ns INTEGER, partial BLOB, full BLOB, "
+                        "archived INTEGER)")
+        self.db.execute("CREATE INDEX entries_size ON entries (size)")
+
+    def rows(self, query, args=()):
+        for row in self.db.execute(query, args):
+            entry = dict(zip(self.fields, row[1:]))
+            entry["id"] = row[0]
+            entry["archived"] = bool(entry["archived"])
+            yield (entry)
+
+    def group(self, size):
+        return (list(self.rows("SELECT * FROM entries WHERE size = ?",
+                               (size,))))
+
+    def insert(self, entry):
+        cursor = self.db.execute("INSERT INTO entries VALUES "
+                                 "(NULL, ?, ?, ?, ?, ?, ?, ?)",
+                                 tuple(entry[field]
+                                       for field in self.fields))
+        entry["id"] = cursor.lastrowid
+
+    def update(self, entry, field):
+        if "id" not in entry:
+            # not stored yet, insert writes everything it has
+            return
+        if field not in self.fields:
+            raise ValueError(field)
+        self.db.execute(f"UPDATE entries SET {field} = ? WHERE id = ?",
+                        (entry[field], entry["id"]))
+
+    def entries(self):
+        return (self.rows("SELECT * FROM entries"))
+
+    def close(self):
+        self.db.close()
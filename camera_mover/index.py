@@ -0,0 +1,223 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+def column_add(db, table, column, column_type):
+    # brings a table made by an older version up to date
+    columns = [row[1] for row in db.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+class MetaCache:
+    # sqlite file remembering the exif tags and hashes of every file seen,
+    # keyed on path, size and mtime so a changed file is never served from
+    # it. entries not used for a while are dropped once there are more than
+    # max_entries of them. it can be shared between threads, the DeviceScan
+    # readers each look images up in it.
+    def __init__(self, path, max_entries=1000000, batch_size=1000):
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.run = time.time_ns()
+        self.pending = 0
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "path TEXT PRIMARY KEY, size INTEGER, "
+                        "mtime_ns INTEGER, exif TEXT, partial TEXT, "
+                        "full TEXT, used INTEGER, phash TEXT)")
+        column_add(self.db, "files", "phash", "TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_used "
+                        "ON files (used)")
+
+    def lookup(self, path, size, mtime_ns):
+        with self.lock:
+            row = self.db.execute("SELECT exif, partial, full, phash FROM "
+                                  "files WHERE path = ? AND size = ? AND "
+                                  "mtime_ns = ?",
+                                  (path, size, mtime_ns)).fetchone()
+        if row is None:
+            return (None)
+        return ({"exif": row[0], "partial": row[1], "full": row[2],
+                 "phash": row[3]})
+
+    def store(self, path, size, mtime_ns, **fields):
+        with self.lock:
+            entry = self.lookup(path, size, mtime_ns)
+            if entry is None:
+                # new or changed file, anything known about the old one is
+                # stale
+                entry = {"exif": None, "partial": None, "full": None,
+                         "phash": None}
+            entry.update(fields)
+            self.db.execute("INSERT OR REPLACE INTO files (path, size, "
+                            "mtime_ns, exif, partial, full, used, phash) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (path, size, mtime_ns, entry["exif"],
+                             entry["partial"], entry["full"], self.run,
+                             entry["phash"]))
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.db.commit()
+                self.pending = 0
+
+    def exif_get(self, path, size, mtime_ns, tag_names):
+        entry = self.lookup(path, size, mtime_ns)
+        if entry is None or entry["exif"] is None:
+            return (None)
+        cached = json.loads(entry["exif"])
+        if not set(tag_names) <= set(cached["tags"]):
+            return (None)
+        with self.lock:
+            self.db.execute("UPDATE files SET used = ? WHERE path = ?",
+                            (self.run, path))
+        return (cached["exif"])
+
+    def exif_set(self, path, size, mtime_ns, tag_names, exif_data):
+        cached = json.dumps({"tags": list(tag_names), "exif": exif_data})
+        self.store(path, size, mtime_ns, exif=cached)
+
+    def hash_get(self, path, size, mtime_ns, kind, algorithm):
+        # kind is "partial", "full" or "phash", hashes are stored as
+        # algorithm:hex
+        entry = self.lookup(path, size, mtime_ns)
+        if entry is None or entry[kind] is None:
+            return (None)
+        cached_algorithm, _, content_hash = entry[kind].partition(":")
+        if cached_algorithm != algorithm:
+            return (None)
+        return (content_hash)
+
+    def hash_set(self, path, size, mtime_ns, kind, algorithm, content_hash):
+        self.store(path, size, mtime_ns,
+                   **{kind: f"{algorithm}:{content_hash}"})
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            count = self.db.execute("SELECT COUNT(*) FROM "
+                                    "files").fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute("DELETE FROM files WHERE path IN (SELECT "
+                                "path FROM files ORDER BY used LIMIT ?)",
+                                (count - self.max_entries,))
+            self.db.commit()
+            self.db.close()
+
+
+class ArchiveIndex:
+    # what the destination already holds: every file named by name_check
+    # along with whatever hashes were ever needed for it. it lives in an
+    # sqlite file in the destination, so a re-run only has to list the
+    # directory rather than stat and hash everything that was archived before.
+    # names are paths relative to the destination when a layout shards it
+    name_pattern = re.compile(r"^(.*)_(\d{3,})\.jpg$")
+
+    def __init__(self, destination, algorithm="md5"):
+        self.destination = destination
+        self.algorithm = algorithm
+        self.db = sqlite3.connect(os.path.join(destination,
+                                               "camera_copy_index.sqlite"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS archive ("
+                        "name TEXT PRIMARY KEY, size INTEGER, "
+                        "mtime_ns INTEGER, partial TEXT, full TEXT, "
+                        "phash TEXT)")
+        column_add(self.db, "archive", "phash", "TEXT")
+        self.sync()
+
+    def sync(self):
+        # files are matched on name only. anything added or removed behind
+        # our back is picked up, but the archive is assumed not to be edited
+        # in place. the listing goes through a temporary table rather than
+        # a set, so a huge archive doesn't have to fit in memory.
+        self.db.execute("CREATE TEMP TABLE on_disk (name TEXT PRIMARY KEY)")
+        for p, d, f in os.walk(self.destination):
+            shard = os.path.relpath(p, self.destination).replace(os.sep, "/")
+            names = [name for name in f if self.name_pattern.match(name)]
+            if shard != ".":
+                names = [shard + "/" + name for name in names]
+            self.db.executemany("INSERT INTO on_disk VALUES (?)",
+                                ((name,) for name in names))
+        self.db.execute("DELETE FROM archive WHERE name NOT IN "
+                        "(SELECT name FROM on_disk)")
+        added = self.db.execute("SELECT name FROM on_disk WHERE name NOT IN "
+                                "(SELECT name FROM archive)").fetchall()
+        for (name,) in added:
+            stat = os.stat(os.path.join(self.destination, name))
+            self.add(name, stat.st_size, stat.st_mtime_ns)
+        self.db.execute("DROP TABLE on_disk")
+        self.db.commit()
+
+    def hash_value(self, stored, algorithm=None):
+        # hashes are stored as algorithm:hex so switching --hash is safe
+        if stored is None:
+            return (None)
+        stored_algorithm, _, content_hash = stored.partition(":")
+        if stored_algorithm != (algorithm or self.algorithm):
+            return (None)
+        return (content_hash)
+
+    def load(self, name_bases, dup_list=None, near_list=None):
+        # numbering carries on from the highest count used in the archive
+        # and archived content is what later duplicates are checked against.
+        # only files archived with --near-dups have a perceptual hash.
+        rows = self.db.execute("SELECT name, size, mtime_ns, partial, full, "
+                               "phash FROM archive")
+        for name, size, mtime_ns, partial, full, phash in rows:
+            base, count = self.name_pattern.match(name).groups()
+            name_bases[base] = max(name_bases.get(base, 0), int(count))
+            if dup_list is not None:
+                dup_list.add(os.path.join(self.destination, name), size,
+                             mtime_ns, self.hash_value(partial),
+                             self.hash_value(full), archived=True)
+            phash = self.hash_value(phash, "dhash")
+            if near_list is not None and phash is not None:
+                near_list.add(os.path.join(self.destination, name),
+                              int(phash, 16), size)
+
+    def add(self, name, size, mtime_ns, partial=None, full=None,
+            phash=None):
+        if partial is not None:
+            partial = f"{self.algorithm}:{partial}"
+        if full is not None:
+            full = f"{self.algorithm}:{full}"
+        if phash is not None:
+            phash = f"dhash:{phash:016x}"
+        self.db.execute("INSERT OR REPLACE INTO archive "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (name, size, mtime_ns, partial, full, phash))
+
+    def hashes_update(self, name, partial=None, full=None):
+        # hashes of an archived file worked out later, anything else known
+        # about it stays
+        if partial is not None:
+            self.db.execute("UPDATE archive SET partial = ? WHERE name = ?",
+                            (f"{self.algorithm}:{partial}", name))
+        if full is not None:
+            self.db.execute("UPDATE archive SET full = ? WHERE name = ?",
+                            (f"{self.algorithm}:{full}", name))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self, dup_list=None):
+        # keep any hashes of archived files worked out during this run
+        if dup_list is not None:
+            for entry in dup_list.entries():
+                if entry["archived"]:
+                    name = os.path.relpath(entry["name"], self.destination)
+                    partial, full = entry["partial"], entry["full"]
+                    self.hashes_update(
+                        name.replace(os.sep, "/"),
+                        partial.hex() if partial is not None else None,
+                        full.hex() if full is not None else None)
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,174 @@
+import math
+import random
+import sys
+import time
+from array import array
+
+try:
+    import resource
+except ImportError:
+    # not on windows
+    resource = None
+
+# transfer methods that don't copy any data
+no_copy_methods = ("rename", "hardlink", "reflink")
+
+
+def peak_rss():
+    # the most memory this process and its finished workers have held at
+    # once, in bytes, or Nones where getrusage isn't available
+    if resource is None:
+        return (None, None)
+    # linux counts in kilobytes, macos in bytes
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return (own, workers)
+
+
+def percentile(ordered, percent):
+    # nearest rank percentile of an already sorted sequence
+    if not ordered:
+        return (None)
+    rank = max(math.ceil((percent / 100) * len(ordered)), 1)
+    return (ordered[rank - 1])
+
+
+def rss_line(own, workers):
+    line = f"Peak Memory: {own / (1 << 20):.1f}MB"
+    if workers:
+        line += f" (workers {workers / (1 << 20):.1f}MB)"
+    return (line)
+
+
+class Metrics:
+    # cumulative seconds and item counts per stage, bytes read and written
+    # and the time spent on each file, for --stats and --metrics-json. each
+    # stage costs a couple of perf_counter calls per file and at most
+    # max_samples latencies are kept, a uniform sample once there are more
+    # files than that, so it is cheap enough to leave on. stages that run in
+    # worker processes are summed across the workers and can add up to more
+    # than the wall time.
+    def __init__(self, max_samples=100000):
+        self.started = time.perf_counter()
+        self.finished = None
+        self.stages = {}
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.methods = {}
+        self.latencies = array("d")
+        self.max_samples = max_samples
+        self.sampler = random.Random(0)
+        self.slowest = None
+
+    def add(self, stage, seconds, count=1):
+        try:
+            totals = self.stages[stage]
+            totals[0] += seconds
+            totals[1] += count
+        except KeyError:
+            self.stages[stage] = [seconds, count]
+
+    def timed(self, stage, iterable):
+        # yields from iterable, counting the time spent waiting on each item
+        # against stage
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start, 0)
+                return
+            self.add(stage, time.perf_counter() - start)
+            yield (item)
+
+    def transferred(self, method, size):
+        if method is None:
+            return
+        self.methods[method] = self.methods.get(method, 0) + 1
+        if method not in no_copy_methods:
+            self.bytes_read += size
+            self.bytes_written += size
+
+    def file_done(self, seconds):
+        self.files += 1
+        if self.slowest is None or seconds > self.slowest:
+            self.slowest = seconds
+        if len(self.latencies) < self.max_samples:
+            self.latencies.append(seconds)
+        else:
+            # reservoir sampling, every file so far is equally likely to be
+            # one of the samples
+            slot = self.sampler.randrange(self.files)
+            if slot < self.max_samples:
+                self.latencies[slot] = seconds
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def report(self):
+        finished = self.finished
+        if finished is None:
+            finished = time.perf_counter()
+        wall = finished - self.started
+        ordered = sorted(self.latencies)
+        own_rss, worker_rss = peak_rss()
+
+        def rate(amount):
+            if wall <= 0:
+                return (None)
+            return (amount / wall)
+
+        stages = {}
+        for stage, (seconds, count) in self.stages.items():
+            stages[stage] = {"seconds": seconds, "count": count,
+                             "share": seconds / wall if wall > 0 else None}
+        report = {
+            "wall_seconds": wall,
+            "files": self.files,
+            "files_per_sec": rate(self.files),
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "read_mb_per_sec": rate(self.bytes_read / (1 << 20)),
+            "write_mb_per_sec": rate(self.bytes_written / (1 << 20)),
+            "latency": {"p50": percentile(ordered, 50),
+                        "p95": percentile(ordered, 95),
+                        "max": self.slowest},
+            "stages": stages,
+            "methods": self.methods,
+            "peak_rss": own_rss,
+            "peak_rss_workers": worker_rss,
+        }
+        return (report)
+
+    def summary(self):
+        report = self.report()
+
+        def ms(seconds):
+            if seconds is None:
+                return ("-")
+            return (f"{seconds * 1000:.2f}ms")
+
+        lines = [f"Wall Time: {report['wall_seconds']:.3f}s",
+                 f"Files/sec: {report['files_per_sec'] or 0:.1f}",
+                 f"Read: {report['bytes_read'] / (1 << 20):.1f}MB "
+                 f"({report['read_mb_per_sec'] or 0:.1f}MB/s)",
+                 f"Written: {report['bytes_written'] / (1 << 20):.1f}MB "
+                 f"({report['write_mb_per_sec'] or 0:.1f}MB/s)",
+                 f"Per File: p50 {ms(report['latency']['p50'])}, "
+                 f"p95 {ms(report['latency']['p95'])}, "
+                 f"max {ms(report['latency']['max'])}"]
+        for stage, totals in sorted(report["stages"].items(),
+                                    key=lambda item: -item[1]["seconds"]):
+            lines.append(f"  {stage}: {totals['seconds']:.3f}s over "
+                         f"{totals['count']} ({(totals['share'] or 0):.0%})")
+        if report["peak_rss"] is not None:
+            lines.append(rss_line(report["peak_rss"],
+                                  report["peak_rss_workers"]))
+        if report["methods"]:
+            lines.append("Transfers: " + ", ".join(
+                f"{method} {count}"
+                for method, count in sorted(report["methods"].items())))
+        return ("\n".join(lines))
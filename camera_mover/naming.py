@@ -0,0 +1,158 @@
+import os
+import sqlite3
+import time
+from functools import lru_cache
+from string import Formatter
+
+from .exif_data import get_full_class_name
+
+strftime = time.strftime
+gmtime = time.gmtime
+
+# a template can be a path, "/" separates the directories the images are
+# sharded into. year, month and day come from datetime.
+name_template = "{make}_{model}_{datetime}"
+name_defaults = {"make": "brand", "model": "camera"}
+date_fields = ("year", "month", "day")
+invalid_chars = ("/", "<", ">", ":", '"', "\\", "|", "?", "*", ",", ".", " ",
+                 "&", "%")
+invalid_table = str.maketrans(dict.fromkeys(invalid_chars, "-"))
+
+
+def char_squash(s, ch):
+    # this was taken from stackoverflow and I don't fully understand it yet.
+    new_str = []
+    l = len(s)
+    for i in range(len(s)):
+        if (s[i] == ch and i != (l-1) and
+           i != 0 and s[i + 1] != ch and s[i-1] != ch):
+            new_str.append(s[i])
+        elif s[i] == ch:
+            if ((i != (l-1) and s[i + 1] == ch) and
+               (i != 0 and s[i-1] != ch)):
+                new_str.append(s[i])
+        else:
+            new_str.append(s[i])
+    return ("".join(i for i in new_str))
+
+
+def path_cleaner_reference(in_str):
+    # the original cleaner, path_cleaner has to give exactly the same names
+    for char in invalid_chars:
+        in_str = char_squash(in_str.replace(char, "-"), "-")
+    return (in_str)
+
+
+def path_cleaner(in_str):
+    # one translate and one split instead of a replace and a char_squash per
+    # invalid character. the passes above always drop leading dashes and
+    # leave one dash between two kept characters, only what is left of a
+    # run of dashes at the very end depends on the order of the passes, so
+    # that bit still goes through the reference on its own.
+    cleaned = in_str.translate(invalid_table)
+    parts = cleaned.split("-")
+    name = "-".join(part for part in parts if part)
+    if name and not parts[-1]:
+        tail = len(cleaned) - len(cleaned.rstrip("-"))
+        name += path_cleaner_reference("x" + in_str[-tail:])[1:]
+    return (name)
+
+
+@lru_cache(maxsize=None)
+def template_tags(template):
+    # the fields a naming template refers to. the date fields are cut out of
+    # datetime, so that is asked for whenever one of them is used.
+    fields = Formatter().parse(template)
+    tags = tuple(field for _, field, _, _ in fields if field)
+    if "datetime" not in tags and any(tag in date_fields for tag in tags):
+        tags += ("datetime",)
+    return (tags)
+
+
+def name_gen2(image, exif_dict, template=name_template, errors=None):
+    # errors collects the class names of whatever kept a tag from being used
+    fields = {}
+    for tag in template_tags(template):
+        if tag in date_fields:
+            continue
+        try:
+            value = exif_dict[tag]
+            if tag.startswith("datetime"):
+                value = value.replace(":", "-").replace(" ", "T")
+        except Exception as e:
+            if errors is not None:
+                errors.append(get_full_class_name(e))
+            if tag.startswith("datetime"):
+                value = strftime("%Y-%m-%dT%H-%M-%S",
+                                 gmtime(os.path.getmtime(image)))
+            else:
+                value = name_defaults.get(tag, "unknown")
+        fields[tag] = value
+    if "datetime" in fields:
+        date = fields["datetime"]
+        fields.update(year=date[0:4], month=date[5:7], day=date[8:10])
+    # each directory level is cleaned on its own so the separators survive.
+    # levels that come out empty are dropped, so the name always stays
+    # relative to the destination
+    parts = (path_cleaner(part.format(**fields))
+             for part in template.split("/"))
+    name = "/".join(part for part in parts if part)
+    return (name)
+
+
+def base_name_gen(image, exif_data, template=name_template, errors=None):
+    if exif_data != 1:
+        base_name = name_gen2(image, exif_data, template, errors)
+    else:
+        mod_time = strftime("%Y-%m-%dT%H-%M-%S",
+                            gmtime(os.path.getmtime(image)))
+        base_name = "bad_exif_" + mod_time
+        # still sharded, by the file's mtime
+        shard = name_gen2(image, {}, template).rpartition("/")[0]
+        if shard:
+            base_name = shard + "/" + base_name
+    return (base_name)
+
+
+class DiskNameCounts:
+    # stands in for the name_bases dict name_check keeps its counts in, for
+    # --low-memory. the counts live in a throwaway sqlite file, so a run
+    # over millions of files doesn't have to hold every name it gave out.
+    def __init__(self, path=""):
+        # an empty path is a temporary file sqlite removes on close
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE counts (name TEXT PRIMARY KEY, "
+                        "count INTEGER)")
+
+    def __getitem__(self, name):
+        row = self.db.execute("SELECT count FROM counts WHERE name = ?",
+                              (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return (row[0])
+
+    def __setitem__(self, name, count):
+        self.db.execute("INSERT OR REPLACE INTO counts VALUES (?, ?)",
+                        (name, count))
+
+    def get(self, name, default=None):
+        try:
+            return (self[name])
+        except KeyError:
+            return (default)
+
+    def close(self):
+        self.db.close()
+
+
+def name_check(name, name_bases):
+    try:
+        name_bases[name] += 1
+    except KeyError:
+        name_bases[name] = 1
+    count = name_bases[name]
+    name = "_".join((name, str(count).rjust(3, "0")))
+    name = name + ".jpg"
+    return (name)
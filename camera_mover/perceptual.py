@@ -0,0 +1,195 @@
+import importlib.util
+import io
+from array import array
+
+from .exif_data import exif_thumbnail
+
+try:
+    popcount = int.bit_count
+except AttributeError:
+    # before python 3.10
+    def popcount(value):
+        return (bin(value).count("1"))
+
+# how many of the 64 bits two images may differ in and still count as the
+# same picture
+near_distance = 5
+
+
+def pillow_available():
+    return (importlib.util.find_spec("PIL") is not None)
+
+
+def near_index_new(distance=near_distance):
+    # a linear numpy scan beats the tree by a wide margin on big archives,
+    # the tree is there for when numpy isn't
+    if importlib.util.find_spec("numpy") is not None:
+        return (ArrayNearIndex(distance))
+    return (NearIndex(distance))
+
+
+def dhash(picture):
+    # 64 bit difference hash of a PIL image: shrink to 9x8 grey and set a bit
+    # wherever a pixel is darker than the one to its right. it survives
+    # resizing, re-compression and exif edits.
+    from PIL import Image
+    pixels = list(picture.convert("L").resize((9, 8), Image.BILINEAR)
+                  .getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[(row * 9) + column]
+            value = (value << 1) | (left < pixels[(row * 9) + column + 1])
+    return (value)
+
+
+def image_phash(image, exif_content=None):
+    # perceptual hash of image from the thumbnail in its exif when there is
+    # one, otherwise from a decode at the smallest scale the jpeg allows.
+    # None when Pillow can't make sense of it. Pillow is only needed for
+    # --near-dups, so it isn't imported before then.
+    from PIL import Image
+    thumbnail = None
+    if exif_content is not None:
+        thumbnail = exif_thumbnail(exif_content)
+    try:
+        if thumbnail is not None:
+            picture = Image.open(io.BytesIO(thumbnail))
+            picture.load()
+            # cameras pad thumbnails out to 4:3 with black bars, which the
+            # full image doesn't have
+            box = picture.convert("L").point(lambda level: level > 16 and
+                                             255).getbbox()
+            if box is not None:
+                picture = picture.crop(box)
+            return (dhash(picture))
+        with Image.open(image) as picture:
+            picture.draft("L", (64, 64))
+            return (dhash(picture))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return (None)
+
+
+class NearIndex:
+    # BK-tree of perceptual hashes keyed on hamming distance. a lookup only
+    # follows the branches whose distance from the node is within distance
+    # of the query's, so it looks at a small part of a large archive. nodes
+    # are kept in flat lists, children only once a node has any.
+    def __init__(self, distance=near_distance):
+        self.distance = distance
+        self.hashes = array("Q")
+        self.names = []
+        self.sizes = []
+        self.children = []
+
+    def add(self, name, phash, size=0):
+        self.hashes.append(phash)
+        self.names.append(name)
+        self.sizes.append(size)
+        self.children.append(None)
+        node_id = len(self.hashes) - 1
+        if node_id == 0:
+            return
+        node = 0
+        while True:
+            distance = popcount(phash ^ self.hashes[node])
+            children = self.children[node]
+            if children is None:
+                self.children[node] = {distance: node_id}
+                return
+            if distance not in children:
+                children[distance] = node_id
+                return
+            node = children[distance]
+
+    def find(self, phash):
+        # the closest earlier image within distance, the first one added
+        # when there is a tie
+        node = self.closest(phash)
+        if node is None:
+            return (None)
+        return (self.names[node])
+
+    def closest(self, phash):
+        # the node find is after, None when there isn't one
+        if not self.hashes:
+            return (None)
+        best = None
+        pending = [0]
+        while pending:
+            node = pending.pop()
+            distance = popcount(phash ^ self.hashes[node])
+            if distance <= self.distance:
+                if best is None or (distance, node) < best:
+                    best = (distance, node)
+            children = self.children[node]
+            if children is None:
+                continue
+            for child_distance, child in children.items():
+                if abs(child_distance - distance) <= self.distance:
+                    pending.append(child)
+        if best is None:
+            return (None)
+        return (best[1])
+
+    def check(self, name, phash, size=0):
+        # like DupIndex.check: the earlier image name looks the same as, or
+        # None after recording name. looking the same isn't proof of the
+        # same content, so a file larger than the one it matches is never
+        # left out for it. it takes the match's place for later checks and
+        # None is returned, the smaller one stays wherever it already went.
+        node = self.closest(phash)
+        if node is None:
+            self.add(name, phash, size)
+            return (None)
+        if size > self.sizes[node]:
+            self.names[node] = name
+            self.sizes[node] = size
+            return (None)
+        return (self.names[node])
+
+
+class ArrayNearIndex(NearIndex):
+    # the same lookups as NearIndex, but as one vectorized xor and popcount
+    # over every hash so far, about 2ms for a million of them. the array
+    # doubles in size as it fills up.
+    def __init__(self, distance=near_distance):
+        import numpy
+        self.numpy = numpy
+        self.distance = distance
+        self.hashes = numpy.zeros(1024, dtype=numpy.uint64)
+        self.count = 0
+        self.names = []
+        self.sizes = []
+        if hasattr(numpy, "bitwise_count"):
+            self.bit_count = numpy.bitwise_count
+        else:
+            # numpy before 2.0, count through a table of byte popcounts
+            table = numpy.array([popcount(byte) for byte in range(256)],
+                                dtype=numpy.uint8)
+
+            def bit_count(values):
+                counts = table[values.view(numpy.uint8)]
+                return (counts.reshape(-1, 8).sum(axis=1))
+
+            self.bit_count = bit_count
+
+    def add(self, name, phash, size=0):
+        if self.count == len(self.hashes):
+            self.hashes = self.numpy.concatenate(
+                (self.hashes, self.numpy.zeros_like(self.hashes)))
+        self.hashes[self.count] = phash
+        self.count += 1
+        self.names.append(name)
+        self.sizes.append(size)
+
+    def closest(self, phash):
+        if not self.count:
+            return (None)
+        distances = self.bit_count(self.hashes[:self.count] ^
+                                   self.numpy.uint64(phash))
+        closest = int(distances.argmin())
+        if distances[closest] > self.distance:
+            return (None)
+        # argmin gives the first of any tie, the earliest image
+        return (closest)
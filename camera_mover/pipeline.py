@@ -0,0 +1,161 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# only imported by transfer_stage, asyncio is slow to import and isn't
+# needed at all with --transfer-jobs 1.
+
+# how often --transfer-jobs auto looks at the throughput, and how far it
+# can go
+tune_interval = 2.0
+tune_limits = (1, 64)
+
+
+class TransferStage:
+    # keeps up to limit transfers in flight at once, for destinations where
+    # every copy spends most of its time waiting on the network. an asyncio
+    # loop in a thread of its own hands each one to a worker thread with
+    # run_in_executor. submit blocks while limit are already in flight,
+    # which holds up reviewing the next images too, so a slow destination
+    # never has more than limit images queued for it. everything that
+    # depends on a transfer having finished is a callback run from drain in
+    # the thread that submitted it, so the journal, the archive index and
+    # the duplicate index are still only touched from there. names are
+    # given out before submit, so they come out the same as a serial run.
+    # with auto the limit is adjusted every tune_interval seconds, towards
+    # whichever direction last improved the bytes transferred per second.
+    def __init__(self, limit=8, auto=False, metrics=None):
+        self.limit = limit
+        self.metrics = metrics
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        # sizes of the files in flight, see wait_size
+        self.sizes = Counter()
+        self.finished = queue.Queue()
+        self.window_bytes = 0
+        self.executor = ThreadPoolExecutor(tune_limits[1] if auto else limit)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        if auto:
+            asyncio.run_coroutine_threadsafe(self.tune(), self.loop)
+
+    def submit(self, function, args, size, callback):
+        # callback(result, seconds) is run by a later drain once function
+        # has returned in a worker, exceptions are raised from drain
+        start = time.perf_counter()
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+        if self.metrics is not None:
+            self.metrics.add("backpressure", time.perf_counter() - start, 0)
+        # before taking the slot, so a callback raising doesn't leave it
+        # taken for good
+        self.drain()
+        with self.condition:
+            self.in_flight += 1
+            self.sizes[size] += 1
+        asyncio.run_coroutine_threadsafe(
+            self.run(function, args, size, callback), self.loop)
+
+    async def run(self, function, args, size, callback):
+        start = time.perf_counter()
+        error = None
+        result = None
+        try:
+            result = await self.loop.run_in_executor(self.executor, function,
+                                                     *args)
+        except Exception as e:
+            error = e
+        self.finished.put((callback, result, error,
+                           time.perf_counter() - start))
+        with self.condition:
+            self.in_flight -= 1
+            self.sizes[size] -= 1
+            if not self.sizes[size]:
+                del self.sizes[size]
+            self.window_bytes += size
+            self.condition.notify_all()
+
+    async def tune(self):
+        direction = 1
+        last_rate = None
+        while True:
+            await asyncio.sleep(tune_interval)
+            with self.condition:
+                moved = self.window_bytes
+                self.window_bytes = 0
+                busy = self.in_flight >= self.limit
+            if not busy and not moved:
+                # waiting on the reviews, not the destination
+                continue
+            rate = moved / tune_interval
+            if last_rate is not None and rate < last_rate * 0.95:
+                direction = -direction
+            last_rate = rate
+            step = max(1, self.limit // 4)
+            limit = min(max(self.limit + (direction * step), tune_limits[0]),
+                        tune_limits[1])
+            with self.condition:
+                self.limit = limit
+                self.condition.notify_all()
+
+    async def shutdown(self):
+        # only the tuner can still be running by now
+        tasks = [task for task in asyncio.all_tasks()
+                 if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def drain(self):
+        # runs the callbacks of every transfer that has finished, then raises
+        # the first error, so the ones that did succeed are still journaled
+        first_error = None
+        while True:
+            try:
+                callback, result, error, seconds = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            if error is None:
+                try:
+                    callback(result, seconds)
+                except Exception as e:
+                    error = e
+            if first_error is None:
+                first_error = error
+        if first_error is not None:
+            raise first_error
+
+    def wait_size(self, size):
+        # waits for every file of size in flight and runs its callbacks.
+        # the duplicate index only reads files of the size it is checking,
+        # so this is all it takes for a check to never read a file that is
+        # half way through being moved.
+        with self.condition:
+            while self.sizes[size]:
+                self.condition.wait()
+        self.drain()
+
+    def join(self):
+        with self.condition:
+            while self.in_flight:
+                self.condition.wait()
+        self.drain()
+
+    def close(self):
+        # lets everything in flight finish, a transfer is never abandoned
+        # half way
+        try:
+            self.join()
+        finally:
+            asyncio.run_coroutine_threadsafe(self.shutdown(),
+                                             self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.executor.shutdown()
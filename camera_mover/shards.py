@@ -0,0 +1,220 @@
+import csv
+import heapq
+import os
+import re
+import time
+
+from .actions import PlanWriter, action_parser
+from .engine import ImageScan, image_reviews, print_progress
+from .hashing import DiskDupIndex, DupIndex
+from .index import ArchiveIndex, MetaCache
+from .naming import DiskNameCounts, name_check, name_template
+from .perceptual import near_index_new
+
+shard_pattern = re.compile(r"^camera_copy\.shard-(\d+)-of-(\d+)\.csv$")
+shard_fields = ("source", "size", "mtime_ns", "base_name", "partial", "full",
+                "phash")
+
+
+def shard_name(index, count):
+    return (f"camera_copy.shard-{index}-of-{count}.csv")
+
+
+def stored_hash(stored, algorithm):
+    # shard files keep hashes as algorithm:hex like the archive index
+    stored_algorithm, _, content_hash = stored.partition(":")
+    if stored_algorithm != algorithm or not content_hash:
+        return (None)
+    return (content_hash)
+
+
+def shard_review(src, dst, shard, dup=False, jobs=1, hash_algorithm="md5",
+                 cache_path=None, layout=name_template, near_dups=False,
+                 low_memory=False, progress=print_progress, cancel=None,
+                 metrics=None):
+    # the part of a run that can be split across machines. only the images
+    # path_shard puts in shard (index, count) are read, and what is learnt
+    # about each one, its base name, hashes and perceptual hash, goes to a
+    # shard file in dst for shards_merge. nothing is named or transferred.
+    # with dup the partial hash of every image is taken, plus the full hash
+    # of any that match another in the shard, so the merge only has to read
+    # files whose partial hash matches one from another shard.
+    sources = src
+    if isinstance(src, (str, os.PathLike)):
+        sources = [src]
+    index, count = shard
+    if len(sources) > 1:
+        # only needed for several sources
+        from .sources import DeviceScan
+        images = DeviceScan(sources, shard=shard)
+    else:
+        images = ImageScan(sources[0], shard=shard)
+    cache = None
+    if cache_path is not None:
+        cache = MetaCache(cache_path)
+    dup_list = None
+    if dup:
+        if low_memory:
+            dup_list = DiskDupIndex(hash_algorithm, cache=cache)
+        else:
+            dup_list = DupIndex(hash_algorithm, cache=cache)
+    executor = None
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs)
+    if hasattr(images, "reviews"):
+        reviews = images.reviews(executor, cache, template=layout,
+                                 metrics=metrics, near_dups=near_dups)
+    else:
+        reviews = image_reviews(images, executor, cache, template=layout,
+                                metrics=metrics, near_dups=near_dups)
+    rows = []
+    dup_count = 0
+    try:
+        for review in reviews:
+            (image, size, mtime_ns, exif_data, base_name, errors, timings,
+             phash) = review
+            if cancel is not None and cancel.is_set():
+                break
+            start = time.perf_counter()
+            progress(f"Reviewing: {len(rows) + 1} of {images.found} found "
+                     f"(shard {index + 1} of {count})")
+            partial = full = ""
+            if dup_list is not None:
+                dup_of = dup_list.check(image, size, mtime_ns)
+                if dup_of is not None:
+                    dup_count += 1
+                # a duplicate has the same hashes as the file it matched
+                partial, full = dup_list.hashes(dup_of or image, size)
+                partial = f"{hash_algorithm}:{partial}"
+                full = f"{hash_algorithm}:{full}" if full else ""
+            rows.append((image, size, mtime_ns, base_name, partial, full,
+                         f"dhash:{phash:016x}" if phash is not None else ""))
+            if metrics is not None:
+                end = time.perf_counter()
+                metrics.bytes_read += timings[0]
+                for stage, seconds in timings[1].items():
+                    metrics.add(stage, seconds)
+                metrics.add("dedup", end - start)
+                metrics.file_done(sum(timings[1].values()) + end - start)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if dup_list is not None:
+            if metrics is not None:
+                metrics.bytes_read += dup_list.bytes_read
+            dup_list.close()
+        if cache is not None:
+            cache.close()
+    if cancel is not None and cancel.is_set():
+        # a partial shard would quietly leave images out of the merge
+        return (len(rows), dup_count)
+    # sorted by source so the merge can stream every shard at once, and
+    # written under a temporary name so it never sees half a shard
+    rows.sort()
+    path = os.path.join(dst, shard_name(index, count))
+    with open(path + ".tmp", "w", newline="", encoding="utf-8") as handle:
+        writer = csv.writer(handle, quoting=csv.QUOTE_ALL,
+                            lineterminator="\n")
+        writer.writerow(shard_fields)
+        writer.writerows(rows)
+    os.replace(path + ".tmp", path)
+    if progress is print_progress:
+        print(f"")
+    return (len(rows), dup_count)
+
+
+def shard_files(dst):
+    # every shard file of one --shard run in dst, in shard order. raises
+    # ValueError if any are missing or runs with different counts are mixed
+    found = {}
+    for name in os.listdir(dst):
+        match = shard_pattern.match(name)
+        if match:
+            index, count = int(match.group(1)), int(match.group(2))
+            found.setdefault(count, {})[index] = os.path.join(dst, name)
+    if not found:
+        raise ValueError(f"no shard files in {dst}")
+    if len(found) > 1:
+        raise ValueError("shard files from runs split "
+                         f"{' and '.join(str(c) for c in sorted(found))} "
+                         f"ways in {dst}, remove the stale ones")
+    count, paths = found.popitem()
+    missing = [str(index) for index in range(count) if index not in paths]
+    if missing:
+        raise ValueError(f"missing shard {', '.join(missing)} of {count}")
+    return ([paths[index] for index in range(count)])
+
+
+def shard_rows(path):
+    with open(path, newline="", encoding="utf-8") as handle:
+        for row in csv.DictReader(handle):
+            row["size"] = int(row["size"])
+            row["mtime_ns"] = int(row["mtime_ns"])
+            yield (row)
+
+
+def shards_merge(dst, dup=False, destructive=False, hash_algorithm="md5",
+                 near_dups=None, low_memory=False, progress=print_progress):
+    # turns the shard files in dst into one camera_copy.csv plan for
+    # --apply-plan. images are taken in source path order across every
+    # shard, so the result doesn't depend on how many shards there were.
+    # it isn't always the plan an unsharded run would make though, that
+    # goes in scan order, so which of two duplicates is kept and the
+    # numbering that follows from it can differ. names carry on
+    # from the archive and duplicates are checked against the archive and
+    # every shard, with only the hashes no shard took being read here.
+    paths = shard_files(dst)
+    if low_memory:
+        name_bases = DiskNameCounts()
+        dup_list = DiskDupIndex(hash_algorithm)
+    else:
+        name_bases = {}
+        dup_list = DupIndex(hash_algorithm)
+    near_list = None
+    if near_dups is not None:
+        near_list = near_index_new(near_dups)
+    archive = ArchiveIndex(dst, hash_algorithm)
+    plan = PlanWriter(os.path.join(dst, "camera_copy.csv"), dst)
+    item_count = 0
+    dup_count = 0
+    try:
+        archive.load(name_bases, dup_list if dup else None, near_list)
+        rows = heapq.merge(*(shard_rows(path) for path in paths),
+                           key=lambda row: row["source"])
+        for row in rows:
+            image = row["source"]
+            size = row["size"]
+            mtime_ns = row["mtime_ns"]
+            item_count += 1
+            progress(f"Merging: {item_count}")
+            dup_of = None
+            if dup:
+                dup_of = dup_list.check(
+                    image, size, mtime_ns,
+                    stored_hash(row["partial"], hash_algorithm),
+                    stored_hash(row["full"], hash_algorithm))
+            phash = stored_hash(row["phash"], "dhash")
+            near_of = None
+            if dup_of is None and near_list is not None and phash:
+                near_of = dup_of = near_list.check(image, int(phash, 16),
+                                                   size)
+            if dup_of is None:
+                out_name = name_check(row["base_name"], name_bases)
+            elif near_of is not None:
+                dup_count += 1
+                out_name = f"NEAR DUP of {near_of}"
+            else:
+                dup_count += 1
+                out_name = f"DUP of {dup_of}"
+            action_parser(image, out_name, dst, destructive, plan,
+                          size=size, mtime_ns=mtime_ns)
+    finally:
+        plan.close()
+        archive.close(dup_list)
+        dup_list.close()
+        if low_memory:
+            name_bases.close()
+    if progress is print_progress:
+        print(f"")
+    return (item_count, dup_count, item_count)
@@ -0,0 +1,104 @@
+import os
+import queue
+import threading
+import time
+from itertools import chain
+
+from .engine import ImageScan, image_reviews
+from .naming import name_template
+
+
+class DeviceScan:
+    # several sources in one run, e.g. one per card reader. sources on the
+    # same device (st_dev) are read one after another by a thread of their
+    # own, which feeds a bounded queue of image_review results, so a slow
+    # card doesn't hold up a fast one and every device is kept busy. the
+    # reviews are taken from the queues in turn, one per device, so the
+    # order only depends on what is on each device and not on which one
+    # happens to be faster. a dry run names and picks duplicates exactly
+    # like the real run will. naming and duplicate checks still happen one
+    # image at a time in list_review, shared across every source.
+    def __init__(self, sources, exclude=(), queue_size=64, shard=None):
+        self.scans = [ImageScan(source, exclude, shard) for source in sources]
+        self.queue_size = queue_size
+        self.devices = {}
+        for scan in self.scans:
+            try:
+                device = os.stat(scan.directory).st_dev
+            except OSError:
+                # ImageScan skips it anyway
+                device = None
+            self.devices.setdefault(device, []).append(scan)
+
+    @property
+    def found(self):
+        return (sum(scan.found for scan in self.scans))
+
+    def __iter__(self):
+        # a plain listing, every source in turn
+        return (chain.from_iterable(self.scans))
+
+    def reviews(self, executor=None, cache=None, window=64,
+                template=name_template, metrics=None, near_dups=False):
+        # image_reviews over every source, with a thread per device when
+        # there is more than one. they all share the worker pool.
+        if len(self.devices) == 1:
+            return (image_reviews(iter(self), executor, cache, window,
+                                  template, metrics, near_dups))
+        # Metrics isn't thread safe, the time the readers spend is in the
+        # timings of each review anyway
+        review_args = (executor, cache, window, template, None, near_dups)
+        return (self.device_reviews(review_args, metrics))
+
+    def device_reviews(self, review_args, metrics=None):
+        stop = threading.Event()
+        lanes = []
+        for scans in self.devices.values():
+            lane = queue.Queue(self.queue_size)
+            thread = threading.Thread(target=self.device_read,
+                                      args=(scans, lane, stop, review_args),
+                                      daemon=True)
+            lanes.append(lane)
+            thread.start()
+        # each queue is a buffer of up to queue_size reviews a faster
+        # device can get ahead by while its turn comes round
+        turn = 0
+        try:
+            while lanes:
+                turn %= len(lanes)
+                start = time.perf_counter()
+                kind, item = lanes[turn].get()
+                if metrics is not None:
+                    metrics.add("wait", time.perf_counter() - start)
+                if kind == "review":
+                    yield (item)
+                    turn += 1
+                elif kind == "error":
+                    raise item
+                else:
+                    del lanes[turn]
+        finally:
+            # stops the readers if the run ends early
+            stop.set()
+
+    def device_read(self, scans, lane, stop, review_args):
+        def put(kind, item):
+            # gives up once nobody is going to take it
+            while not stop.is_set():
+                try:
+                    lane.put((kind, item), timeout=0.1)
+                except queue.Full:
+                    continue
+                return (True)
+            return (False)
+
+        try:
+            for review in image_reviews(chain.from_iterable(scans),
+                                        *review_args):
+                if not put("review", review):
+                    return
+        except Exception as error:
+            # raised again in the main thread, like a single source would
+            put("error", error)
+            return
+        put("done", None)
@@ -0,0 +1,186 @@
+import os
+import shutil
+import sys
+
+from .hashing import chunk_buffer, hash_chunk_size, hash_file, hash_new
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+transfer_modes = ("auto", "copy", "reflink", "hardlink", "stream")
+# linux ioctl that makes dst share src's extents on copy-on-write filesystems
+FICLONE = 0x40049409
+
+
+def copy_file(src, dst, mode="auto", keep_stat=False):
+    # copies src to dst the cheapest way the filesystem allows and returns
+    # the method that worked. reflinks share the data outright,
+    # copy_file_range and sendfile keep the data in the kernel, and a plain
+    # copy is the fallback for everything else.
+    method = None
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        in_fd = fsrc.fileno()
+        out_fd = fdst.fileno()
+        if mode in ("auto", "reflink") and fcntl is not None:
+            try:
+                fcntl.ioctl(out_fd, FICLONE, in_fd)
+                method = "reflink"
+            except OSError:
+                pass
+        size = os.fstat(in_fd).st_size
+        kernel_copies = []
+        if hasattr(os, "copy_file_range"):
+            kernel_copies.append(("copy_file_range", os.copy_file_range))
+        if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+            kernel_copies.append(("sendfile", lambda i, o, n, offset_src:
+                                  os.sendfile(o, i, offset_src, n)))
+        for name, kernel_copy in kernel_copies:
+            if method is not None:
+                break
+            offset = 0
+            try:
+                while offset < size:
+                    if name == "sendfile":
+                        sent = kernel_copy(in_fd, out_fd, size - offset,
+                                           offset)
+                    else:
+                        sent = kernel_copy(in_fd, out_fd, size - offset,
+                                           offset_src=offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                method = name
+            except OSError:
+                # not supported between these two files, start over
+                os.ftruncate(out_fd, 0)
+                os.lseek(out_fd, 0, os.SEEK_SET)
+        if method is None:
+            shutil.copyfileobj(fsrc, fdst, hash_chunk_size)
+            method = "copy"
+    if keep_stat:
+        shutil.copystat(src, dst)
+    else:
+        shutil.copymode(src, dst)
+    return (method)
+
+
+def copy_hashed(src, dst, algorithm="md5", verify=False, keep_stat=False):
+    # reads src once and feeds every chunk to both the hasher and dst. with
+    # verify, dst is dropped from the page cache and read back, and has to
+    # hash the same before the copy is trusted.
+    buffer = chunk_buffer()
+    view = memoryview(buffer)
+    hasher = hash_new(algorithm)
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = fsrc.readinto(buffer)
+        while size:
+            hasher.update(view[:size])
+            fdst.write(view[:size])
+            size = fsrc.readinto(buffer)
+        if verify:
+            fdst.flush()
+            os.fsync(fdst.fileno())
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fdst.fileno(), 0, 0,
+                                 os.POSIX_FADV_DONTNEED)
+    content_hash = hasher.hexdigest()
+    if keep_stat:
+        shutil.copystat(src, dst)
+    else:
+        shutil.copymode(src, dst)
+    if verify and hash_file(dst, algorithm) != content_hash:
+        os.remove(dst)
+        raise OSError(f"{dst} does not match {src} after copying")
+    return (content_hash)
+
+
+def transfer_file(src, dst, mode="auto", move=False, algorithm="md5",
+                  verify=False):
+    # returns the method used, which the journal keeps for every file, and
+    # the content hash when the copy was streamed through a hasher
+    stream = mode == "stream" or verify
+    same_device = False
+    try:
+        dst_dir = os.path.dirname(os.path.abspath(dst))
+        same_device = os.stat(src).st_dev == os.stat(dst_dir).st_dev
+    except OSError:
+        pass
+    if move:
+        if same_device:
+            try:
+                os.rename(src, dst)
+                return ("rename", None)
+            except OSError:
+                pass
+        content_hash = None
+        if stream:
+            content_hash = copy_hashed(src, dst, algorithm, verify,
+                                       keep_stat=True)
+            method = "stream"
+        else:
+            method = copy_file(src, dst, "auto", keep_stat=True)
+        # only reached once the copy is complete (and verified)
+        os.remove(src)
+        return (method, content_hash)
+    if mode == "hardlink" and same_device:
+        try:
+            os.link(src, dst)
+            return ("hardlink", None)
+        except OSError:
+            pass
+    if stream:
+        return ("stream", copy_hashed(src, dst, algorithm, verify))
+    if mode == "hardlink":
+        mode = "auto"
+    return (copy_file(src, dst, mode), None)
+
+
+def dir_ensure(full_name, made_dirs=None):
+    # creates the shard directory full_name goes in. made_dirs remembers the
+    # ones already there so a run only checks each directory once.
+    directory = os.path.dirname(full_name)
+    if made_dirs is not None:
+        if directory in made_dirs:
+            return
+        made_dirs.add(directory)
+    os.makedirs(directory, exist_ok=True)
+
+
+def action_run(action, image, full_name, transfer="auto", algorithm="md5",
+               verify=False, made_dirs=None):
+    method = None
+    content_hash = None
+    if action in ("move", "copy"):
+        dir_ensure(full_name, made_dirs)
+    if action == "delete":
+        os.remove(image)
+    elif action in ("move", "copy"):
+        method, content_hash = transfer_file(image, full_name, transfer,
+                                             action == "move", algorithm,
+                                             verify)
+    return (method, content_hash)
+
+
+def transfer_stage(transfer_jobs=1, metrics=None):
+    # the TransferStage for --transfer-jobs, None for one at a time
+    if transfer_jobs != "auto" and transfer_jobs < 2:
+        return (None)
+    # only needed for more than one, and slow to import
+    from .pipeline import TransferStage
+    if transfer_jobs == "auto":
+        return (TransferStage(8, auto=True, metrics=metrics))
+    return (TransferStage(transfer_jobs, metrics=metrics))
+
+
+def transfer_job(action, image, full_name, transfer="auto", algorithm="md5",
+                 verify=False):
+    # action_run plus the stat the archive index wants, both round trips to
+    # the destination that are better off in a worker
+    method, content_hash = action_run(action, image, full_name, transfer,
+                                      algorithm, verify)
+    stat = None
+    if full_name is not None:
+        stat = os.stat(full_name)
+    return (method, content_hash, stat)
@@ -0,0 +1,313 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from .engine import image_pattern
+
+# inotify event bits, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+watch_mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+# wd, mask, cookie and name length, the name follows padded with nuls
+event_header = struct.Struct("iIII")
+
+# filesystems like FAT only keep mtimes to the nearest 2 seconds, so a
+# directory changed this recently is listed again even if its mtime looks
+# the same as last time
+mtime_slack = 3.0
+
+
+class Inotify:
+    # the few inotify calls DirWatcher needs, through ctypes so there is
+    # nothing to install. raises OSError where inotify isn't available.
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            self.add_watch_call = libc.inotify_add_watch
+            self.rm_watch_call = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError("libc has no inotify")
+        self.add_watch_call.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                        ctypes.c_uint32)
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path):
+        wd = self.add_watch_call(self.fd, os.fsencode(path), watch_mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return (wd)
+
+    def rm_watch(self, wd):
+        # fails harmlessly when the kernel already dropped the watch
+        self.rm_watch_call(self.fd, wd)
+
+    def read(self, timeout):
+        # (wd, mask, name) for everything that happened, waiting up to
+        # timeout seconds for the first event
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return ([])
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return ([])
+        events = []
+        pos = 0
+        while pos + event_header.size <= len(data):
+            wd, mask, _, length = event_header.unpack_from(data, pos)
+            pos += event_header.size
+            name = data[pos:pos + length].rstrip(b"\x00")
+            pos += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return (events)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirWatcher:
+    # an endless ImageScan for --watch: first every image already under
+    # the directories, then each new one as it turns up, until cancel is set or
+    # ctrl-c. inotify tells us about new files where the kernel has it,
+    # otherwise only directories whose mtime moved are listed again, so
+    # neither ever rescans the whole tree. a file is only handed out once
+    # its size and mtime have held still for settle seconds, so a copy
+    # still being written isn't picked up half way. files already older
+    # than that go straight out. anything in exclude and the directories in
+    # ignore, like a destination inside the drop directory, are passed over.
+    # on_idle is called each time everything handed out so far has been
+    # dealt with and the watcher is about to wait for more.
+    def __init__(self, directories, exclude=(), ignore=(), settle=2.0,
+                 interval=1.0, cancel=None, poll=False):
+        if isinstance(directories, (str, os.PathLike)):
+            directories = [directories]
+        self.directories = directories
+        self.exclude = exclude
+        self.ignore = {os.path.realpath(path) for path in ignore}
+        self.settle = settle
+        self.interval = interval
+        self.cancel = cancel
+        self.found = 0
+        self.on_idle = None
+        self.inotify = None
+        if not poll:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                pass
+        # directory -> the image names in it already handed out
+        self.seen = {}
+        # directory -> mtime_ns when polling, watch descriptor with inotify
+        self.dirs = {}
+        self.wds = {}
+        # path -> (size, mtime_ns, when it was last seen changing)
+        self.pending = {}
+
+    def __iter__(self):
+        return (self.watch())
+
+    def stopped(self):
+        return (self.cancel is not None and self.cancel.is_set())
+
+    def watch(self):
+        try:
+            for directory in self.directories:
+                self.dir_add(directory)
+            while not self.stopped():
+                ready = self.ready()
+                if ready:
+                    for path in ready:
+                        self.found += 1
+                        yield (path)
+                    # everything available is out, don't let image_reviews
+                    # sit on it waiting for more
+                    yield (None)
+                    continue
+                if self.on_idle is not None:
+                    self.on_idle()
+                self.wait()
+        except KeyboardInterrupt:
+            # ctrl-c is how a watch is meant to end, let the run finish up
+            return
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+
+    def dir_add(self, directory):
+        # starts watching directory and everything under it, and queues the
+        # images already there. the watch goes on before the listing, so
+        # nothing created in between is missed.
+        if os.path.realpath(directory) in self.ignore:
+            return
+        try:
+            if self.inotify is not None:
+                wd = self.inotify.add_watch(directory)
+                self.dirs[directory] = wd
+                self.wds[wd] = directory
+            else:
+                self.dirs[directory] = os.stat(directory).st_mtime_ns
+        except OSError:
+            # like os.walk, directories that can't be read are skipped
+            return
+        self.seen.setdefault(directory, set())
+        self.dir_list(directory)
+
+    def dir_drop(self, directory):
+        for known in list(self.dirs):
+            if known == directory or known.startswith(directory + os.sep):
+                wd = self.dirs.pop(known)
+                if self.inotify is not None:
+                    self.wds.pop(wd, None)
+                    self.inotify.rm_watch(wd)
+                self.seen.pop(known, None)
+
+    def dir_list(self, directory):
+        # queues new images in directory, forgets the ones that are gone so
+        # a file dropped in again under the same name is picked up, and adds
+        # any new subdirectories
+        names = set()
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif image_pattern.search(entry.name):
+                        names.add(entry.name)
+                        self.file_touched(entry.path)
+        except OSError:
+            return
+        self.seen[directory] &= names
+        for subdir in subdirs:
+            if subdir not in self.dirs:
+                self.dir_add(subdir)
+
+    def file_touched(self, path):
+        directory, name = os.path.split(path)
+        if name in self.seen.get(directory, ()) or path in self.exclude:
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.pending.pop(path, None)
+            return
+        now = time.time()
+        if now - (stat.st_mtime_ns / 1e9) >= self.settle:
+            # nothing has written to it for long enough already
+            now -= self.settle
+        current = (stat.st_size, stat.st_mtime_ns)
+        known = self.pending.get(path)
+        if known is None or known[:2] != current:
+            self.pending[path] = current + (now,)
+
+    def ready(self):
+        # pending files that have held still for settle seconds, in path
+        # order so the numbering doesn't depend on event order
+        now = time.time()
+        ready = []
+        for path, (size, mtime_ns, since) in list(self.pending.items()):
+            if now - since < self.settle:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+                continue
+            del self.pending[path]
+            directory, name = os.path.split(path)
+            if directory in self.seen:
+                self.seen[directory].add(name)
+                ready.append(path)
+        ready.sort()
+        return (ready)
+
+    def wait(self):
+        # blocks until something might have changed, for at most interval
+        # seconds so cancel and pending files are looked at again in time
+        timeout = self.interval
+        if self.pending:
+            soonest = min(since for _, _, since in self.pending.values())
+            timeout = min(timeout, max(soonest + self.settle - time.time(),
+                                       0.05))
+        if self.inotify is not None:
+            self.events(self.inotify.read(timeout))
+        else:
+            time.sleep(timeout)
+            self.poll()
+
+    def events(self, events):
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # the kernel dropped events, list everything again
+                for directory in list(self.dirs):
+                    if directory in self.dirs:
+                        self.dir_list(directory)
+                continue
+            directory = self.wds.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                self.dir_drop(directory)
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.dir_add(path)
+                elif mask & IN_MOVED_FROM:
+                    self.dir_drop(path)
+            elif image_pattern.search(name):
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.seen[directory].discard(name)
+                    self.pending.pop(path, None)
+                else:
+                    self.file_touched(path)
+
+    def poll(self):
+        # one stat per directory, only the ones that changed are listed
+        now = time.time()
+        for directory, mtime_ns in list(self.dirs.items()):
+            if directory not in self.dirs:
+                # dropped along with its parent
+                continue
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                self.dir_drop(directory)
+                continue
+            if current != mtime_ns or now - (current / 1e9) < mtime_slack:
+                self.dirs[directory] = current
+                self.dir_list(directory)